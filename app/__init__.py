@@ -7,91 +7,97 @@ from flask_wtf.csrf import CSRFProtect
 import os
 from logging.handlers import RotatingFileHandler
 from flask_migrate import Migrate
-from datetime import datetime
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 csrf = CSRFProtect()
 
-def create_app():
-    logging.basicConfig(level=logging.DEBUG)
+def create_app(config=None):
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
     logger = logging.getLogger(__name__)
     logger.info('creating flask app instance')
     
+    from app import conditional, database, metrics
+
     app = Flask(__name__)
     app.secret_key = os.environ.get('SECRET_KEY', 'dev')
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db?timeout=20'
+    app.config['SQLALCHEMY_DATABASE_URI'] = database.database_uri()
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-    migrate = Migrate(app, db)
+    app.config['SEND_FILE_MAX_AGE_DEFAULT'] = conditional.STATIC_MAX_AGE
+    app.config['ASSET_VERSION'] = conditional.asset_version(app)
+    app.url_defaults(conditional.static_url_version(app))
+    if config:
+        app.config.update(config)
+    database.init_app(app)
+
+    # render_as_batch lets autogenerate alter SQLite tables by copying them
+    migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(app.root_path), 'migrations'),
+                      render_as_batch=True)
     
     db.init_app(app)
     bcrypt.init_app(app)
     csrf.init_app(app)
+
+    from app.storage import storage
+    storage.init_app(app)
+
+    from app.cache import cache
+    cache.init_app(app)
+
+    from app.live import broker
+    broker.init_app(app)
+
+    from app.ingest import limiter, writes
+    limiter.init_app(app)
+    writes.init_app(app)
     
     login_manager = LoginManager()
     login_manager.init_app(app)
     login_manager.login_view = 'login'
     
     from app.models import User
+    from app import search  # registers the full-text index DDL with create_all
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return User.cached(int(user_id))
     
     with app.app_context():
-        db.create_all()
+        database.configure_engine(db.engine, app.config['SQLITE_PRAGMAS'])
+        metrics.init_app(app, db.engine, storage)
 
     from app.routes import main
     app.register_blueprint(main)
+
+    from app.commands import register_commands
+    register_commands(app)
     
     @app.after_request
     def add_header(response):
-        if request.endpoint in ['main.profile', 'main.dashboard']:
+        if request.endpoint == 'main.profile':
             response.cache_control.no_store = True
         return response
     
     if not app.debug:
         if not os.path.exists('logs'):
             os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/app.log', maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-        ))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+        # every app in the process logs through the same 'app' logger, so
+        # the file handler is only added by the first
+        log_path = os.path.abspath('logs/app.log')
+        if not any(getattr(handler, 'baseFilename', None) == log_path for handler in app.logger.handlers):
+            file_handler = RotatingFileHandler(log_path, maxBytes=10 * 1024 * 1024, backupCount=10)
+            file_handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+            ))
+            file_handler.setLevel(logging.INFO)
+            app.logger.addHandler(file_handler)
         app.logger.setLevel(logging.INFO)
+        # slow requests and blown query budgets are logged by app.metrics,
+        # which propagates to app.logger and so to the same file
         app.logger.info('App startup')
     
-    def timeago(dt, default="just now"):
-        """
-        Returns string representing "time since" e.g.
-        3 days ago, 5 hours ago.
-        """
-        if dt is None:
-            return default
-        now = datetime.utcnow()
-        diff = now - dt
-
-        periods = (
-            (diff.days // 365, "year", "years"),
-            (diff.days // 30, "month", "months"),
-            (diff.days // 7, "week", "weeks"),
-            (diff.days, "day", "days"),
-            (diff.seconds // 3600, "hour", "hours"),
-            (diff.seconds // 60, "minute", "minutes"),
-            (diff.seconds, "second", "seconds"),
-        )
-
-        for period, singular, plural in periods:
-            if period:
-                return "{} {} ago".format(period, singular if period == 1 else plural)
-
-        return default
-
-    def timeago_filter(dt):
-        return timeago(dt)
-
-    app.jinja_env.filters['timeago'] = timeago_filter
+    from app.fragments import render_post_cards
+    app.jinja_env.globals['post_cards'] = render_post_cards
     
     return app
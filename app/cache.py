@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+MISSING = object()
+
+
+class LocalBackend:
+    """
+    Thread-safe in-process LRU with per-entry expiry. Each process (web
+    worker, job worker) has its own copy, so entries written elsewhere only
+    go stale for as long as their TTL.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key, MISSING)
+            if entry is MISSING:
+                return MISSING
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Cache:
+    """
+    Read-through cache in front of the database. Keys are
+    'namespace:...' strings and hits and misses are counted per namespace.
+    Whole namespaces are invalidated by bumping a generation number that is
+    part of every key built with key(), so backends never have to scan.
+
+    Any object with get/set/delete/clear (get returning MISSING on a miss)
+    can be passed as the backend, e.g. one shared between processes.
+    """
+
+    def __init__(self, backend=None, default_ttl=300):
+        self.backend = backend or LocalBackend()
+        self.default_ttl = default_ttl
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', None)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 1024)
+        app.config.setdefault('CACHE_DEFAULT_TTL', self.default_ttl)
+
+        self.backend = app.config['CACHE_BACKEND'] or LocalBackend(app.config['CACHE_MAX_ENTRIES'])
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+        app.extensions['cache'] = self
+
+    def _count(self, key, hit):
+        namespace = key.partition(':')[0]
+        if hit:
+            self.hits[namespace] += 1
+        else:
+            self.misses[namespace] += 1
+
+    def get(self, key, default=None):
+        value = self.backend.get(key)
+        self._count(key, value is not MISSING)
+        return default if value is MISSING else value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl or self.default_ttl)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.backend.delete(key)
+
+    def get_or_set(self, key, loader, ttl=None):
+        """Returns the cached value, calling loader() and caching its result on a miss."""
+        value = self.backend.get(key)
+        self._count(key, value is not MISSING)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def get_many(self, keys, loader, ttl=None):
+        """
+        Read-through for a batch: loader(missing_keys) returns a dict for the
+        keys that weren't cached, so one query can fill all of them.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.backend.get(key)
+            self._count(key, value is not MISSING)
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+
+        if missing:
+            loaded = loader(missing)
+            for key in missing:
+                found[key] = loaded.get(key)
+                self.set(key, found[key], ttl)
+        return found
+
+    def generation(self, namespace):
+        # generations are timestamps rather than counters, so an evicted
+        # generation can never come back as one that older keys still use
+        value = self.backend.get(f"{namespace}:generation")
+        if value is MISSING:
+            value = time.time_ns()
+            self.backend.set(f"{namespace}:generation", value)
+        return value
+
+    def key(self, namespace, *parts):
+        return ':'.join([namespace, str(self.generation(namespace)), *map(str, parts)])
+
+    def invalidate(self, namespace):
+        """Drops every key() built for namespace."""
+        self.backend.set(f"{namespace}:generation", max(time.time_ns(), self.generation(namespace) + 1))
+
+    def stats(self):
+        namespaces = sorted(set(self.hits) | set(self.misses))
+        return {
+            'entries': len(self.backend) if hasattr(self.backend, '__len__') else None,
+            'namespaces': {
+                namespace: {
+                    'hits': self.hits[namespace],
+                    'misses': self.misses[namespace],
+                    'hit_ratio': round(self.hits[namespace] / ((self.hits[namespace] + self.misses[namespace]) or 1), 3)
+                }
+                for namespace in namespaces
+            }
+        }
+
+    def clear(self):
+        self.backend.clear()
+        self.hits.clear()
+        self.misses.clear()
+
+
+cache = Cache()
@@ -0,0 +1,102 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, or_, select
+from app import db
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db():
+    """Create the database, or bring it up to date, by running the migrations."""
+    from flask_migrate import upgrade
+
+    upgrade()
+    click.echo('database is up to date')
+
+
+@click.command('reconcile-counts')
+@with_appcontext
+def reconcile_counts():
+    """Drop duplicate likes and recompute every post's like/comment counters."""
+    from app.models import Post, Like, Comment
+
+    keep = select(func.min(Like.id)).group_by(Like.user_id, Like.post_id)
+    duplicates = Like.query.filter(Like.id.notin_(keep)).delete(synchronize_session=False)
+
+    like_total = select(func.count(Like.id)).where(Like.post_id == Post.id).scalar_subquery()
+    comment_total = select(func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+    # cached cards and page ETags are keyed on version, so only posts whose counts change bump it
+    updated = Post.query.filter(or_(Post.like_count != like_total, Post.comment_count != comment_total)).update({
+        Post.like_count: like_total,
+        Post.comment_count: comment_total,
+        Post.version: Post.version + 1
+    }, synchronize_session=False)
+
+    db.session.commit()
+    click.echo(f'removed {duplicates} duplicate likes, reconciled {updated} posts')
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index():
+    """Rebuild the full-text post search index from existing rows."""
+    from app import search
+
+    if not search.fts_enabled(db.engine):
+        click.echo('full-text index is only used on sqlite, nothing to rebuild')
+        return
+    indexed = search.rebuild_search_index()
+    click.echo(f'indexed {indexed} posts')
+
+
+@click.command('reindex-spots')
+@with_appcontext
+def reindex_spots():
+    """Compute geohashes for spots that don't have one yet."""
+    from app import geo
+    from app.models import Spot
+
+    spots = Spot.query.filter(Spot.geohash.is_(None)) \
+        .with_entities(Spot.id, Spot.latitude, Spot.longitude) \
+        .all()
+    if spots:
+        ids, latitudes, longitudes = zip(*spots)
+        geohashes = geo.encode_many(latitudes, longitudes)
+        db.session.bulk_update_mappings(Spot, [
+            {'id': spot_id, 'geohash': geohash} for spot_id, geohash in zip(ids, geohashes)
+        ])
+    db.session.commit()
+    click.echo(f'indexed {len(spots)} spots')
+
+
+@click.command('run-worker')
+@click.option('--processes', default=2, show_default=True, help='Number of worker processes.')
+@with_appcontext
+def run_worker(processes):
+    """Process queued background jobs until interrupted."""
+    from app import jobs
+
+    click.echo(f'starting {processes} worker processes')
+    jobs.run_worker(processes)
+
+
+@click.command('check-query-plans')
+def check_query_plans():
+    """Fail if a hot endpoint scans a table, sorts without an index or goes over its query budget."""
+    from app import query_plans
+
+    failures = query_plans.check_query_plans()
+    for request, statement, problems in failures:
+        click.echo(f'{request}: {"; ".join(problems)}\n    {statement}', err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo(f'all queries for {len(query_plans.HOT_REQUESTS)} hot requests use indexes and fit their budgets')
+
+
+def register_commands(app):
+    app.cli.add_command(init_db)
+    app.cli.add_command(reconcile_counts)
+    app.cli.add_command(rebuild_search_index)
+    app.cli.add_command(reindex_spots)
+    app.cli.add_command(run_worker)
+    app.cli.add_command(check_query_plans)
@@ -0,0 +1,73 @@
+import hashlib
+import os
+import time
+from flask import current_app, make_response, request, session
+
+# pages with forms get a new ETag at least this often, so a 304 never keeps
+# a CSRF token past half of its one hour lifetime
+TOKEN_BUCKET_SECONDS = 1800
+
+# for versioned static URLs, which can be cached for good
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+def asset_version(app):
+    """Newest mtime under the templates and static folders, so a deploy changes every ETag."""
+    newest = 0
+    for folder in (os.path.join(app.root_path, app.template_folder), app.static_folder):
+        for root, _, files in os.walk(folder):
+            for name in files:
+                newest = max(newest, int(os.stat(os.path.join(root, name)).st_mtime))
+    return newest
+
+
+def make_etag(*parts):
+    """
+    Builds an ETag from values that identify a version of a resource (ids,
+    counters, version columns), so it can be checked before anything is
+    rendered.
+    """
+    key = repr((current_app.config['ASSET_VERSION'],) + parts)
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def page_etag(*parts):
+    """make_etag for HTML pages that embed a CSRF token."""
+    return make_etag(int(time.time() // TOKEN_BUCKET_SECONDS), *parts)
+
+
+def not_modified(etag, cache_control='private, no-cache'):
+    """
+    Returns a 304 if a GET is for a version the client already has,
+    otherwise None. Never answers 304 while flash messages are waiting to
+    be shown.
+    """
+    if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        return None
+    if not request.if_none_match.contains(etag):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def validated(response, etag, cache_control='private, no-cache'):
+    response = make_response(response)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def static_url_version(app):
+    """
+    Adds the file's mtime to url_for('static') links, so static files can be
+    served with a long max-age and still update on deploy.
+    """
+    def add_version(endpoint, values):
+        if endpoint != 'static' or 'filename' not in values:
+            return
+        path = os.path.join(app.static_folder, values['filename'])
+        if os.path.isfile(path):
+            values.setdefault('v', int(os.stat(path).st_mtime))
+    return add_version
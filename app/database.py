@@ -0,0 +1,110 @@
+import logging
+import os
+import random
+import sqlite3
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError, PendingRollbackError
+from sqlalchemy.pool import QueuePool
+from app import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATABASE_URI = 'sqlite:///database.db'
+
+# how long a SQLite connection waits for another writer before giving up
+BUSY_TIMEOUT_MS = 5000
+
+# WAL lets readers carry on while one connection writes, and with it
+# synchronous=NORMAL only syncs at checkpoints, which is still safe
+# against application crashes
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+    ('foreign_keys', 'ON'),
+)
+
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 2.0
+
+
+def database_uri():
+    """DATABASE_URL from the environment, falling back to a SQLite file next to the app."""
+    uri = os.getenv('DATABASE_URL', DEFAULT_DATABASE_URI)
+    # Heroku-style URLs use a scheme SQLAlchemy no longer accepts
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def is_sqlite(uri):
+    return uri.startswith('sqlite')
+
+
+def engine_options(uri):
+    if not is_sqlite(uri):
+        return {'pool_size': 10, 'max_overflow': 20, 'pool_pre_ping': True, 'pool_recycle': 1800}
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        # Flask-SQLAlchemy shares one connection for in-memory databases
+        return {}
+    # keep connections open, pragmas and all, instead of reconnecting for every checkout
+    return {
+        'poolclass': QueuePool,
+        'pool_size': 5,
+        'max_overflow': 10,
+        'connect_args': {'check_same_thread': False, 'timeout': BUSY_TIMEOUT_MS / 1000}
+    }
+
+
+def init_app(app):
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    app.config.setdefault('SQLITE_PRAGMAS', SQLITE_PRAGMAS)
+
+
+def configure_engine(engine, pragmas):
+    """Applies the SQLite pragmas on every new connection. Call before the engine's first connect."""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and 'locked' in str(error.orig)
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Full-jitter exponential backoff, so writers that collided don't retry in lockstep."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def commit_with_retry(work, attempts=RETRY_ATTEMPTS):
+    """
+    Runs work() and commits, retrying the whole unit when the database is
+    locked. A failed flush rolls the transaction back, so retrying just the
+    commit would silently drop the writes; work has to be safe to run
+    again. Returns work()'s result and raises once the attempts run out.
+    """
+    for attempt in range(attempts):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except (OperationalError, PendingRollbackError) as e:
+            db.session.rollback()
+            if isinstance(e, OperationalError) and not is_lock_error(e):
+                raise
+            if attempt == attempts - 1:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning('database locked, retrying in %.3fs (attempt %d of %d)', delay, attempt + 1, attempts)
+            time.sleep(delay)
@@ -0,0 +1,63 @@
+from sqlalchemy import and_, func, select
+from app import db, media
+from app.models import Post, Like, Comment, Spot, User
+
+
+def _discount_engagement(model, counter, user_id):
+    """
+    Takes a user's likes or comments off the counters of other people's
+    posts and bumps those posts' versions so their cards and pages refresh.
+    """
+    removed = select(func.count(model.id)) \
+        .where(and_(model.post_id == Post.id, model.user_id == user_id)) \
+        .scalar_subquery()
+    engaged = select(model.post_id).where(model.user_id == user_id)
+    Post.query.filter(Post.id.in_(engaged), Post.user_id != user_id) \
+        .update({counter: counter - removed, Post.version: Post.version + 1},
+                synchronize_session=False)
+
+
+def delete_user(user_id):
+    """
+    Deletes a user with their posts, likes and comments, and the likes and
+    comments others left on those posts, in a few set-based statements
+    instead of loading each row. Their spots stay on the map without an
+    owner. Media no one else uses is queued for removal from S3. Returns
+    False if the user doesn't exist. The caller commits.
+    """
+    user = db.session.query(User.id, User.avatar_digest).filter_by(id=user_id).first()
+    if user is None:
+        return False
+
+    _discount_engagement(Like, Post.like_count, user_id)
+    _discount_engagement(Comment, Post.comment_count, user_id)
+
+    posts = select(Post.id).where(Post.user_id == user_id)
+    media.release_blobs('post', [digest for digest, in
+                                 db.session.query(Post.media_digest).filter(Post.user_id == user_id)])
+    media.release_blobs('avatar', [user.avatar_digest])
+
+    # the foreign keys cascade too; deleting explicitly keeps this correct
+    # on connections that don't enforce them
+    Like.query.filter((Like.user_id == user_id) | Like.post_id.in_(posts)).delete(synchronize_session=False)
+    Comment.query.filter((Comment.user_id == user_id) | Comment.post_id.in_(posts)).delete(synchronize_session=False)
+    Post.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    Spot.query.filter_by(user_id=user_id).update({Spot.user_id: None}, synchronize_session=False)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    return True
+
+
+def delete_post(post_id):
+    """
+    Deletes a post with its likes and comments and releases its media.
+    Returns False if the post doesn't exist. The caller commits.
+    """
+    digest = db.session.query(Post.media_digest).filter_by(id=post_id).first()
+    if digest is None:
+        return False
+
+    media.release_blobs('post', [digest.media_digest])
+    Like.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    Comment.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    Post.query.filter_by(id=post_id).delete(synchronize_session=False)
+    return True
@@ -0,0 +1,26 @@
+from flask import render_template
+from markupsafe import Markup
+from app.cache import cache
+
+# cards are keyed by version, so this only bounds how long unused ones linger
+CARD_CACHE_TTL = 3600
+
+
+def card_key(post):
+    return f"card:{post.id}:{post.version}"
+
+
+def render_post_cards(posts):
+    """
+    Renders the feed cards for posts, reusing any cached card whose post
+    version hasn't changed. Cards hold nothing viewer- or time-specific
+    (liked state and relative times are applied in the browser), so one
+    cached copy serves every viewer.
+    """
+    keys = {card_key(post): post for post in posts}
+
+    def render(missing):
+        return {key: render_template('post_card.html', post=keys[key]) for key in missing}
+
+    cards = cache.get_many(keys, render, ttl=CARD_CACHE_TTL)
+    return Markup(''.join(cards[key] for key in keys))
@@ -0,0 +1,237 @@
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# ~5m cells, which is finer than any viewport we serve
+GEOHASH_PRECISION = 9
+
+# upper bound on the number of geohash ranges one viewport query ORs together
+MAX_COVER_CELLS = 24
+
+# at this zoom and above the map gets individual spots instead of clusters
+CLUSTER_MAX_ZOOM = 13
+
+MAX_VIEWPORT_SPOTS = 500
+
+# upper bound on the number of clusters one viewport can return
+MAX_VIEWPORT_CLUSTERS = 256
+
+EARTH_RADIUS_KM = 6371.0088
+
+# when no radius is given, nearby() widens its search from the first radius
+# until it has enough spots or reaches the second
+NEARBY_START_RADIUS_KM = 2.0
+NEARBY_MAX_RADIUS_KM = 256.0
+# the most radius searches that takes, counting the first
+NEARBY_MAX_PASSES = math.ceil(math.log2(NEARBY_MAX_RADIUS_KM / NEARBY_START_RADIUS_KM)) + 1
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if longitude >= mid:
+                bits = bits * 2 + 1
+                lng_range[0] = mid
+            else:
+                bits = bits * 2
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = bits * 2 + 1
+                lat_range[0] = mid
+            else:
+                bits = bits * 2
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def encode_many(latitudes, longitudes, precision=GEOHASH_PRECISION):
+    """Vectorized encode() for arrays of coordinates, used for bulk backfills."""
+    import numpy as np
+
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+
+    lat_index = np.floor((np.asarray(latitudes, dtype=np.float64) + 90.0) / 180.0 * (1 << lat_bits))
+    lng_index = np.floor((np.asarray(longitudes, dtype=np.float64) + 180.0) / 360.0 * (1 << lng_bits))
+    lat_index = np.clip(lat_index, 0, (1 << lat_bits) - 1).astype(np.int64)
+    lng_index = np.clip(lng_index, 0, (1 << lng_bits) - 1).astype(np.int64)
+
+    # interleave the bits, longitude first, most significant bit first
+    interleaved = np.zeros(lat_index.shape, dtype=np.int64)
+    for bit in range(total_bits):
+        if bit % 2 == 0:
+            value = (lng_index >> (lng_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_index >> (lat_bits - 1 - bit // 2)) & 1
+        interleaved = (interleaved << 1) | value
+
+    alphabet = np.array(list(BASE32))
+    chars = [
+        alphabet[(interleaved >> (5 * (precision - 1 - position))) & 31]
+        for position in range(precision)
+    ]
+    return [''.join(row) for row in zip(*chars)]
+
+
+def cell_size(precision):
+    """Returns the (latitude, longitude) extent in degrees of one geohash cell."""
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def _steps(start, stop, step):
+    value = start
+    while value < stop:
+        yield value
+        value += step
+    yield stop
+
+
+def _box_cells(south, west, north, east, precision):
+    lat_step, lng_step = cell_size(precision)
+    return {
+        encode(lat, lng, precision)
+        for lat in _steps(south, north, lat_step)
+        for lng in _steps(west, east, lng_step)
+    }
+
+
+def _cell_estimate(boxes, precision):
+    lat_step, lng_step = cell_size(precision)
+    return sum(
+        (math.ceil((n - s) / lat_step) + 1) * (math.ceil((e - w) / lng_step) + 1)
+        for s, w, n, e in boxes
+    )
+
+
+def split_bbox(south, west, north, east):
+    """Splits a box that crosses the antimeridian into two that don't."""
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def cover(south, west, north, east, max_cells=MAX_COVER_CELLS):
+    """
+    Returns the geohash prefixes of the finest grid that covers the box in at
+    most max_cells cells. An empty prefix means the box is too big to prune
+    and every row is a candidate.
+    """
+    boxes = split_bbox(south, west, north, east)
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        if _cell_estimate(boxes, precision) > max_cells * 4:
+            continue
+
+        cells = set()
+        for box in boxes:
+            cells |= _box_cells(*box, precision)
+        if len(cells) <= max_cells:
+            return sorted(cells)
+
+    return ['']
+
+
+def prefix_range(column, prefix):
+    """Index-friendly equivalent of column LIKE 'prefix%' for geohashes."""
+    return (column >= prefix) & (column < prefix + '~')
+
+
+def cluster_precision(zoom, south, west, north, east):
+    """
+    Geohash length to group spots by at a given map zoom, coarsened if the
+    box would otherwise produce more than MAX_VIEWPORT_CLUSTERS cells.
+    """
+    boxes = split_bbox(south, west, north, east)
+    precision = min(max((zoom + 1) // 2, 1), 6)
+    while precision > 1 and _cell_estimate(boxes, precision) > MAX_VIEWPORT_CLUSTERS:
+        precision -= 1
+    return precision
+
+
+def radius_bbox(latitude, longitude, radius_km):
+    """Returns the (south, west, north, east) box enclosing a circle."""
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south = max(latitude - lat_delta, -90.0)
+    north = min(latitude + lat_delta, 90.0)
+
+    widest = max(abs(south), abs(north))
+    if widest >= 90.0:
+        return south, -180.0, north, 180.0
+
+    lng_delta = lat_delta / math.cos(math.radians(widest))
+    if lng_delta >= 180.0:
+        return south, -180.0, north, 180.0
+
+    west = longitude - lng_delta
+    east = longitude + lng_delta
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return south, west, north, east
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """Great-circle distances from one point to arrays of points."""
+    import numpy as np
+
+    lat1 = math.radians(latitude)
+    lat2 = np.radians(latitudes)
+    dlat = lat2 - lat1
+    dlng = np.radians(longitudes) - math.radians(longitude)
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def nearest(latitude, longitude, candidates, radius_km, limit):
+    """
+    Ranks (id, latitude, longitude) candidates by distance and returns up to
+    limit (id, distance_km) pairs within radius_km, closest first.
+    """
+    if not candidates:
+        return []
+
+    # numpy is only needed here and for backfills, so it isn't loaded at startup
+    import numpy as np
+
+    ids, latitudes, longitudes = (np.asarray(column) for column in zip(*candidates))
+    distances = haversine_km(latitude, longitude, latitudes.astype(np.float64), longitudes.astype(np.float64))
+
+    within = np.flatnonzero(distances <= radius_km)
+    if len(within) > limit:
+        within = within[np.argpartition(distances[within], limit - 1)[:limit]]
+    within = within[np.argsort(distances[within], kind='stable')]
+    return [(int(ids[i]), float(distances[i])) for i in within]
+
+
+def parse_bbox(value):
+    """
+    Parses 'south,west,north,east' (the format of LatLngBounds.toUrlValue())
+    and raises ValueError if it isn't a valid box.
+    """
+    south, west, north, east = (float(part) for part in value.split(','))
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError(f"invalid bbox: {value}")
+    return south, west, north, east
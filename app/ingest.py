@@ -0,0 +1,387 @@
+"""
+Group commit for likes and comments, with per-user rate limits.
+
+Writes are queued in memory and a background thread flushes whatever has
+gathered in the last few milliseconds as one transaction, so a burst of
+likes on one post costs one lock and one commit instead of one each.
+Each like is a toggle of the row in the database, like it always was. It
+is answered straight away with the count it will make, worked out from
+the database and the toggles still queued, and a user toggling the same
+like twice in a batch writes nothing. Comments wait for their batch to
+commit, so the client gets back a real comment.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import bindparam, insert, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from app import db, metrics, ranking
+from app.database import commit_with_retry
+
+logger = logging.getLogger(__name__)
+
+# how long the first write of a batch waits for others to join it
+FLUSH_DELAY_MS = 5
+# a batch is flushed straight away once it holds this many writes
+MAX_BATCH = 500
+# how long a comment waits for its batch to commit
+COMMIT_TIMEOUT = 15
+
+# kind -> (writes per minute, burst) allowed per user
+RATE_LIMITS = {'like': (120, 30), 'comment': (20, 5)}
+# idle buckets are dropped once there are more than this many
+MAX_BUCKETS = 10000
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'rate limited, retry in {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """
+    Token buckets per user and kind of write: a user can make a burst of
+    writes at once, then as many as the bucket refills. Buckets live in
+    process like the cache, so each web worker enforces its own limit.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits if limits is not None else RATE_LIMITS)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMITS', RATE_LIMITS)
+        self.limits = dict(app.config['RATE_LIMITS'] or {})
+
+    def check(self, kind, user_id):
+        """Takes a token from the user's bucket. Raises RateLimited if it's empty."""
+        limit = self.limits.get(kind)
+        if not limit:
+            return
+        per_minute, burst = limit
+        rate = per_minute / 60
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get((kind, user_id), (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[(kind, user_id)] = (tokens, now)
+                raise RateLimited((1 - tokens) / rate)
+            self._buckets[(kind, user_id)] = (tokens - 1, now)
+            if len(self._buckets) > MAX_BUCKETS:
+                self._prune(now)
+
+    def _prune(self, now):
+        # a bucket that has refilled is the same as no bucket
+        for (kind, user_id), (tokens, updated) in list(self._buckets.items()):
+            per_minute, burst = self.limits.get(kind) or (0, 0)
+            if tokens + (now - updated) * per_minute / 60 >= burst:
+                del self._buckets[(kind, user_id)]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+limiter = RateLimiter()
+
+
+class PendingComment:
+    """A comment waiting to be written. wait() returns once its batch has committed."""
+
+    def __init__(self, user, post_id, text):
+        self.user_id = user.id
+        self.username = user.username
+        self.post_id = post_id
+        self.text = text
+        self.timestamp = datetime.utcnow()
+        self.id = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=COMMIT_TIMEOUT):
+        """Raises LookupError if the post went away first, or whatever stopped the write."""
+        # hand the request's connection back first; with every pooled
+        # connection held by a waiting request the batch could never be written
+        db.session.close()
+        if not self._done.wait(timeout):
+            raise TimeoutError('comment was not written in time')
+        if self.error is not None:
+            raise self.error
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'text': self.text,
+            'timestamp': self.timestamp.isoformat(),
+            'user': {'id': self.user_id, 'username': self.username}
+        }
+
+
+class WriteBuffer:
+    """
+    Queues likes and comments and writes them in batches from a background
+    thread. With WRITE_BUFFER_MS set to 0 every write is flushed by the
+    request that made it instead.
+    """
+
+    def __init__(self, flush_delay_ms=FLUSH_DELAY_MS, max_batch=MAX_BATCH):
+        self.flush_delay = flush_delay_ms / 1000
+        self.max_batch = max_batch
+        # (user_id, post_id) -> +1 or -1, the change to the post's count an odd
+        # number of queued toggles makes; an even number cancels out
+        self._likes = {}
+        self._comments = []
+        # like count changes not committed yet, per post, queued and being written
+        self._queued_deltas = Counter()
+        self._flushing_likes = {}
+        self._flushing_deltas = Counter()
+        # bumped whenever likes being written are committed or dropped, so a
+        # request knows whether the database changed under its read
+        self._generation = 0
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._app = None
+        self._flusher = None
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_BUFFER_MS', self.flush_delay * 1000)
+        app.config.setdefault('WRITE_BUFFER_MAX_BATCH', self.max_batch)
+        self.flush_delay = app.config['WRITE_BUFFER_MS'] / 1000
+        self.max_batch = app.config['WRITE_BUFFER_MAX_BATCH']
+        # a background thread would get a database of its own
+        if app.config['SQLALCHEMY_DATABASE_URI'] in ('sqlite://', 'sqlite:///:memory:'):
+            self.flush_delay = 0
+        if self._app is None:
+            atexit.register(self._flush_at_exit)
+        self._app = app
+
+    @property
+    def buffering(self):
+        return self.flush_delay > 0
+
+    def toggle_like(self, user, post_id):
+        """
+        Queues a toggle of the user's like on the post and returns (liked,
+        like_count) as they will be once it's written, or None if the post
+        doesn't exist.
+        """
+        from app.models import Like, Post
+
+        pair = (user.id, post_id)
+        while True:
+            with self._condition:
+                generation = self._generation
+            row = db.session.query(Post.like_count, Like.id) \
+                .outerjoin(Like, (Like.post_id == Post.id) & (Like.user_id == user.id)) \
+                .filter(Post.id == post_id) \
+                .first()
+            if row is None:
+                return None
+            like_count, like_id = row
+
+            with self._condition:
+                # a batch was committed while this read, which may or may not
+                # have seen it
+                if self._generation != generation:
+                    continue
+                queued = self._likes.get(pair, 0)
+                # the row as it will be with every toggle before this one applied
+                odd = (queued != 0) != (self._flushing_likes.get(pair, 0) != 0)
+                was_liked = (like_id is not None) != odd
+                delta = -1 if was_liked else 1
+                if queued:
+                    del self._likes[pair]
+                else:
+                    self._likes[pair] = delta
+                self._queued_deltas[post_id] += delta
+                like_count += self._queued_deltas[post_id] + self._flushing_deltas[post_id]
+                self._queued()
+                break
+
+        Post.remember_liked(user.id, post_id, not was_liked)
+        return not was_liked, max(0, like_count)
+
+    def add_comment(self, user, post_id, text):
+        """Queues a comment and returns its PendingComment."""
+        comment = PendingComment(user, post_id, text)
+        with self._condition:
+            self._comments.append(comment)
+            self._queued()
+        return comment
+
+    def _queued(self):
+        if not self.buffering:
+            return
+        self._condition.notify()
+        if self._flusher is None and self._app is not None:
+            self._flusher = threading.Thread(target=self._run, name='write-buffer', daemon=True)
+            self._flusher.start()
+
+    def after_write(self):
+        """Flushes on the request's own session when writes aren't buffered."""
+        if not self.buffering:
+            # the flush also writes whatever other requests queued meanwhile, so
+            # how many statements it takes depends on load, not on this view
+            metrics.waive_query_budget()
+            self.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._likes or self._comments):
+                    self._condition.wait()
+                deadline = time.monotonic() + self.flush_delay
+                while len(self._likes) + len(self._comments) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            try:
+                with self._app.app_context():
+                    self.flush()
+                    db.session.remove()
+            except Exception:
+                logger.exception('flushing likes and comments failed')
+
+    def _flush_at_exit(self):
+        if self._app is not None and (self._likes or self._comments):
+            with self._app.app_context():
+                self.flush()
+
+    def flush(self):
+        """Writes everything queued so far in one transaction. Must be called inside an app context."""
+        with self._flush_lock:
+            with self._condition:
+                likes, self._likes = self._likes, {}
+                comments, self._comments = self._comments, []
+                self._flushing_likes = dict(likes)
+                self._flushing_deltas, self._queued_deltas = self._queued_deltas, Counter()
+            if not likes and not comments:
+                return
+
+            try:
+                try:
+                    commit_with_retry(lambda: self._write(likes, comments))
+                except IntegrityError:
+                    # a post or user was deleted while its writes were queued;
+                    # writing them one at a time drops just those
+                    db.session.rollback()
+                    self._write_each(likes, comments)
+            except Exception as e:
+                self._forget(self._flushing_likes)
+                for comment in comments:
+                    comment.finish(e)
+                raise
+            finally:
+                with self._condition:
+                    # whatever is left was dropped
+                    self._settle(dict(self._flushing_likes))
+                    self._flushing_deltas = Counter()
+
+            for comment in comments:
+                if not comment._done.is_set():
+                    comment.finish()
+
+    def _write_each(self, likes, comments):
+        for pair, delta in likes.items():
+            try:
+                commit_with_retry(lambda: self._write({pair: delta}, []))
+            except IntegrityError:
+                db.session.rollback()
+                self._forget({pair: delta})
+                with self._condition:
+                    self._settle({pair: delta})
+        for comment in comments:
+            try:
+                commit_with_retry(lambda: self._write({}, [comment]))
+            except IntegrityError:
+                db.session.rollback()
+                comment.finish(LookupError(f'post {comment.post_id} not found'))
+
+    def _commit(self, likes):
+        # toggle_like reads the database, then the likes being written;
+        # committing and settling under the lock puts a batch in exactly one
+        with self._condition:
+            db.session.commit()
+            self._settle(likes)
+
+    def _settle(self, likes):
+        """Stops counting likes as being written. The caller holds the condition."""
+        for pair, delta in likes.items():
+            if self._flushing_likes.pop(pair, None) is not None:
+                self._flushing_deltas[pair[1]] -= delta
+        self._generation += 1
+
+    def _forget(self, likes):
+        from app.models import Post
+
+        # what was remembered for these never made it to the database
+        for user_id, post_id in likes:
+            Post.forget_liked(user_id, post_id)
+
+    def _write(self, likes, comments):
+        """
+        Applies and commits a batch: each queued like toggles the user's like
+        row, then every touched post's counters, version and hot score move
+        once.
+        """
+        from app.models import Comment, Like, Post
+
+        like_deltas = Counter()
+        if likes:
+            pairs = tuple_(Like.user_id, Like.post_id)
+            existing = set(db.session.query(Like.user_id, Like.post_id).filter(pairs.in_(list(likes))))
+            added = [pair for pair in likes if pair not in existing]
+            removed = [pair for pair in likes if pair in existing]
+            if removed:
+                Like.query.filter(pairs.in_(removed)).delete(synchronize_session=False)
+            if added:
+                db.session.execute(insert(Like.__table__), [
+                    {'user_id': user_id, 'post_id': post_id} for user_id, post_id in added
+                ])
+            like_deltas.update(post_id for _, post_id in added)
+            like_deltas.subtract(post_id for _, post_id in removed)
+
+        comment_counts = Counter(comment.post_id for comment in comments)
+        if comments:
+            rows = [
+                Comment(text=comment.text, user_id=comment.user_id, post_id=comment.post_id,
+                        timestamp=comment.timestamp)
+                for comment in comments
+            ]
+            db.session.add_all(rows)
+            db.session.flush()
+            for comment, row in zip(comments, rows):
+                comment.id = row.id
+
+        changes = [
+            {'b_id': post_id, 'b_likes': like_deltas[post_id], 'b_comments': comment_counts[post_id],
+             'b_weight': ranking.LIKE_WEIGHT * like_deltas[post_id] + ranking.COMMENT_WEIGHT * comment_counts[post_id]}
+            for post_id in set(like_deltas) | set(comment_counts)
+            if like_deltas[post_id] or comment_counts[post_id]
+        ]
+        if changes:
+            post = Post.__table__
+            db.session.execute(
+                update(post).where(post.c.id == bindparam('b_id')).values(
+                    like_count=post.c.like_count + bindparam('b_likes'),
+                    comment_count=post.c.comment_count + bindparam('b_comments'),
+                    version=post.c.version + 1,
+                    hot_score=ranking.bumped(post.c.hot_score, bindparam('b_weight'))
+                ),
+                changes
+            )
+        self._commit(likes)
+
+
+writes = WriteBuffer()
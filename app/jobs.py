@@ -0,0 +1,199 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from app import db
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = timedelta(seconds=30)
+# a job that has been running this long is assumed to have lost its worker
+STALE_AFTER = timedelta(minutes=30)
+POLL_INTERVAL = 1.0
+
+HANDLERS = {}
+# kind -> interval, for handlers the worker runs on a schedule
+PERIODIC = {}
+
+
+def handler(kind):
+    """Registers a function as the handler for jobs of the given kind."""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def periodic(kind, interval):
+    """
+    Registers a handler the worker runs every interval, one run at a time.
+    It's called with last_run, the ISO time its previous run started, or
+    None the first time.
+    """
+    def register(func):
+        PERIODIC[kind] = interval
+        return handler(kind)(func)
+    return register
+
+
+def enqueue(kind, **payload):
+    """Adds a job to the current session. It runs once the caller commits."""
+    from app.models import Job
+
+    job = Job(kind=kind, payload=payload)
+    db.session.add(job)
+    return job
+
+
+def claim_next():
+    """
+    Marks the oldest runnable job as running and returns its id, or None if
+    the queue is empty. The conditional UPDATE makes the claim atomic, so
+    several dispatchers can share one queue.
+    """
+    from app.models import Job
+
+    now = datetime.utcnow()
+    while True:
+        job_id = db.session.query(Job.id) \
+            .filter(Job.status == 'queued', Job.run_after <= now) \
+            .order_by(Job.id) \
+            .limit(1) \
+            .scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+
+        claimed = Job.query.filter_by(id=job_id, status='queued') \
+            .update({'status': 'running', 'started_at': now, 'attempts': Job.attempts + 1},
+                    synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id
+
+
+def schedule_next(kind, last_run):
+    """Queues the next run of a periodic job, an interval after last_run (or now)."""
+    job = enqueue(kind, last_run=last_run.isoformat() if last_run else None)
+    if last_run:
+        job.run_after = last_run + PERIODIC[kind]
+    return job
+
+
+def schedule_periodic():
+    """
+    Queues a run of each periodic job that has none waiting, picking up
+    from its last finished run. Called when the worker starts.
+    """
+    from app.models import Job
+
+    pending = {kind for kind, in db.session.query(Job.kind)
+               .filter(Job.kind.in_(list(PERIODIC)), Job.status.in_(('queued', 'running')))
+               .distinct()}
+    for kind in PERIODIC.keys() - pending:
+        last_run = db.session.query(db.func.max(Job.started_at)) \
+            .filter(Job.kind == kind, Job.status == 'done') \
+            .scalar()
+        schedule_next(kind, last_run)
+    db.session.commit()
+
+
+def requeue_stale():
+    from app.models import Job
+
+    requeued = Job.query.filter(Job.status == 'running', Job.started_at < datetime.utcnow() - STALE_AFTER) \
+        .update({'status': 'queued'}, synchronize_session=False)
+    db.session.commit()
+    return requeued
+
+
+def run_job(job_id):
+    """Runs one claimed job and records the outcome. Called inside a worker process."""
+    from app.models import Job
+
+    job = Job.query.get(job_id)
+    func = HANDLERS.get(job.kind)
+
+    try:
+        if func is None:
+            raise LookupError(f"no handler for job kind {job.kind}")
+        func(**job.payload)
+    except Exception as e:
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        job.error = str(e)
+        if job.attempts < MAX_ATTEMPTS:
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + RETRY_DELAY * job.attempts
+            logger.warning('job %s (%s) failed, retrying: %s', job.id, job.kind, e)
+        else:
+            job.status = 'failed'
+            logger.exception('job %s (%s) failed', job.id, job.kind)
+            on_failure = getattr(func, 'on_failure', None)
+            if on_failure:
+                on_failure(**job.payload)
+            if job.kind in PERIODIC:
+                # the next run catches up on this one's work
+                last_run = job.payload.get('last_run')
+                schedule_next(job.kind, datetime.fromisoformat(last_run) if last_run else None)
+        db.session.commit()
+        return
+
+    job.status = 'done'
+    job.finished_at = datetime.utcnow()
+    if job.kind in PERIODIC:
+        schedule_next(job.kind, job.started_at)
+    db.session.commit()
+
+
+_worker_app = None
+
+
+def _init_worker():
+    global _worker_app
+    from app import create_app
+
+    _worker_app = create_app()
+    _load_handlers()
+    # loaded up front so the first job doesn't pay for importing Pillow and moviepy
+    from app import transcode  # noqa: F401
+
+
+def _run_in_worker(job_id):
+    with _worker_app.app_context():
+        run_job(job_id)
+
+
+def _load_handlers():
+    # handler modules register themselves on import
+    from app import media, ranking  # noqa: F401
+
+
+def run_worker(processes):
+    """
+    Claims jobs from the queue and runs them on a pool of worker processes
+    until interrupted. Must be called inside an app context.
+    """
+    _load_handlers()
+    requeue_stale()
+    schedule_periodic()
+
+    context = multiprocessing.get_context('spawn')
+    in_flight = set()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker) as pool:
+        while True:
+            while len(in_flight) < processes:
+                job_id = claim_next()
+                if job_id is None:
+                    break
+                in_flight.add(pool.submit(_run_in_worker, job_id))
+
+            if in_flight:
+                done, in_flight = wait(in_flight, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception():
+                        logger.error('worker process error: %s', future.exception())
+            else:
+                time.sleep(POLL_INTERVAL)
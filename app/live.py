@@ -0,0 +1,215 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+logger = logging.getLogger(__name__)
+
+# how often the watcher looks for changes made by other processes
+POLL_SECONDS = 2
+# a stream sends a comment this often so proxies don't time it out
+KEEPALIVE_SECONDS = 15
+# how long a long-poll request waits for something to happen
+LONG_POLL_SECONDS = 25
+# events kept for clients that reconnect with Last-Event-ID
+HISTORY_SIZE = 1000
+# a client can follow the like counts of this many posts
+MAX_WATCHED_POSTS = 200
+# last known like counts kept for posts nobody is watching at the moment
+MAX_TRACKED_COUNTS = 10000
+
+
+class Broker:
+    """
+    In-process pub/sub for live feed updates. Events get increasing ids and
+    are kept in a short history, so a stream or long-poll just waits for ids
+    past the last one it sent, and reconnecting clients pick up where they
+    left off.
+
+    Each process only sees what it publishes itself, so a watcher thread
+    also polls the database: for posts that became ready (wherever they
+    were processed) and for like counts of the posts clients are watching.
+    Likes made through this process are published straight away.
+    """
+
+    def __init__(self, poll_seconds=POLL_SECONDS, history_size=HISTORY_SIZE):
+        self.poll_seconds = poll_seconds
+        self._history = deque(maxlen=history_size)
+        self._last_id = 0
+        self._condition = threading.Condition()
+        self._watched = Counter()
+        self._like_counts = {}
+        self._app = None
+        self._watcher = None
+        self._latest_post_id = None
+        self._processing = set()
+
+    def init_app(self, app):
+        self._app = app
+        self.poll_seconds = app.config.get('LIVE_POLL_SECONDS', self.poll_seconds)
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def publish(self, kind, data):
+        with self._condition:
+            self._last_id += 1
+            self._history.append((self._last_id, kind, data))
+            self._condition.notify_all()
+
+    def publish_likes(self, post_id, likes):
+        """Publishes a post's like count if it differs from the last one published."""
+        with self._condition:
+            if self._like_counts.get(post_id) == likes:
+                return
+            self._like_counts[post_id] = likes
+        self.publish('likes', {'post_id': post_id, 'likes': likes})
+
+    def wait(self, after_id, timeout):
+        """
+        Returns the events after after_id, waiting up to timeout seconds for
+        one to arrive. A client that was on another process (or before a
+        restart) may be ahead of this one; it gets events from now on.
+        """
+        self._start_watcher()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if after_id > self._last_id:
+                after_id = self._last_id
+            while self._last_id <= after_id:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return [], after_id
+                self._condition.wait(remaining)
+            events = [event for event in self._history if event[0] > after_id]
+            return events, self._last_id
+
+    def watch(self, post_ids):
+        with self._condition:
+            self._watched.update(post_ids)
+
+    def unwatch(self, post_ids):
+        # the last known counts stay, so a long-poll client that comes back
+        # still hears about likes made between its requests
+        with self._condition:
+            self._watched.subtract(post_ids)
+            for post_id in post_ids:
+                if self._watched[post_id] <= 0:
+                    del self._watched[post_id]
+
+    def _start_watcher(self):
+        if self._watcher is not None or self._app is None:
+            return
+        with self._condition:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch_database, name='live-watcher', daemon=True)
+                self._watcher.start()
+
+    def _watch_database(self):
+        from app import db
+
+        while True:
+            try:
+                with self._app.app_context():
+                    self.poll()
+                    db.session.remove()
+            except Exception:
+                logger.exception('live update poll failed')
+            time.sleep(self.poll_seconds)
+
+    def poll(self):
+        """Publishes posts that became ready and like counts that changed since the last poll."""
+        from app import db
+        from app.models import Post
+
+        if self._latest_post_id is None:
+            self._latest_post_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+
+        new_posts = db.session.query(Post.id, Post.status) \
+            .filter(Post.id > self._latest_post_id) \
+            .order_by(Post.id) \
+            .all()
+        if new_posts:
+            self._latest_post_id = new_posts[-1].id
+        self._processing.update(post.id for post in new_posts if post.status == 'processing')
+        ready = [post.id for post in new_posts if post.status == 'ready']
+        if self._processing:
+            statuses = dict(db.session.query(Post.id, Post.status).filter(Post.id.in_(self._processing)))
+            # deleted posts drop out along with finished ones
+            self._processing = {post_id for post_id, status in statuses.items() if status == 'processing'}
+            ready.extend(post_id for post_id, status in statuses.items() if status == 'ready')
+        for post_id in sorted(ready):
+            self.publish('post', {'post_id': post_id})
+
+        with self._condition:
+            watched = list(self._watched)
+        for start in range(0, len(watched), 500):
+            chunk = watched[start:start + 500]
+            for post_id, likes in db.session.query(Post.id, Post.like_count).filter(Post.id.in_(chunk)):
+                if post_id in self._like_counts:
+                    self.publish_likes(post_id, likes)
+                else:
+                    # the client rendered the post with this count already
+                    with self._condition:
+                        self._like_counts.setdefault(post_id, likes)
+
+        with self._condition:
+            if len(self._like_counts) > MAX_TRACKED_COUNTS:
+                self._like_counts = {
+                    post_id: likes for post_id, likes in self._like_counts.items() if post_id in self._watched
+                }
+
+
+broker = Broker()
+
+
+def parse_post_ids(value):
+    """The post ids a client is showing, from a comma separated list, newest kept."""
+    post_ids = []
+    for part in (value or '').split(','):
+        if part.strip().isdigit():
+            post_ids.append(int(part))
+    return set(post_ids[-MAX_WATCHED_POSTS:])
+
+
+def visible(event, post_ids):
+    _, kind, data = event
+    return kind == 'post' or data['post_id'] in post_ids
+
+
+def event_stream(post_ids, last_event_id):
+    """Server-sent events for the watched posts until the client goes away."""
+    broker.watch(post_ids)
+    try:
+        # tells EventSource how long to wait before reconnecting
+        yield f'retry: {POLL_SECONDS * 1000}\n\n'
+        last_id = broker.last_id if last_event_id is None else last_event_id
+        while True:
+            events, last_id = broker.wait(last_id, KEEPALIVE_SECONDS)
+            events = [event for event in events if visible(event, post_ids)]
+            if not events:
+                yield ': keepalive\n\n'
+            for event_id, kind, data in events:
+                yield f'id: {event_id}\nevent: {kind}\ndata: {json.dumps(data)}\n\n'
+    finally:
+        broker.unwatch(post_ids)
+
+
+def long_poll(post_ids, last_event_id, timeout=LONG_POLL_SECONDS):
+    """
+    For clients without EventSource: waits for the next events for the
+    watched posts and returns them with the id to pass back next time.
+    """
+    broker.watch(post_ids)
+    try:
+        if last_event_id is None:
+            return [], broker.last_id
+        events, last_id = broker.wait(last_event_id, timeout)
+        return [
+            {'id': event_id, 'event': kind, 'data': data}
+            for event_id, kind, data in events if visible((event_id, kind, data), post_ids)
+        ], last_id
+    finally:
+        broker.unwatch(post_ids)
@@ -0,0 +1,349 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from collections import Counter
+from contextlib import closing
+from io import BytesIO
+from mimetypes import guess_type, guess_extension
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from app import db, jobs
+from app.database import commit_with_retry
+from app.storage import MULTIPART_CHUNK_SIZE, storage
+
+logger = logging.getLogger(__name__)
+
+AVATAR_SIZE = 160
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.mp4': 'video/mp4',
+    '.jpg': 'image/jpeg',
+}
+
+# originals wait here, private, until a worker has processed them
+STAGING_PREFIX = 'uploads/'
+
+
+def stage_upload(file_storage):
+    """
+    Streams an upload to a private staging object for a worker to pick up.
+    Returns (key, mime_type).
+    """
+    mime_type, _ = guess_type(file_storage.filename)
+    if not mime_type:
+        raise ValueError("Could not determine the MIME type")
+
+    key = f"{STAGING_PREFIX}{uuid.uuid4()}{guess_extension(mime_type) or ''}"
+    file_storage.stream.seek(0)
+    storage.stream_upload(file_storage.stream, key, mime_type, acl='private')
+    return key, mime_type
+
+
+def content_digest(stream):
+    """SHA-256 hex digest of a seekable stream, read a chunk at a time and rewound."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(MULTIPART_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def acquire_blob(kind, digest, mime_type):
+    """
+    Takes a reference on the blob for these bytes, creating it if this is
+    the first upload of them. Returns (blob, created); created means the
+    caller has to stage the file for processing, which is also the case
+    when an earlier attempt at processing it failed. Runs in the caller's
+    transaction.
+    """
+    from app.models import MediaBlob
+
+    while True:
+        referenced = MediaBlob.query.filter_by(kind=kind, digest=digest) \
+            .update({'ref_count': MediaBlob.ref_count + 1}, synchronize_session=False)
+        if referenced:
+            retry = MediaBlob.query.filter_by(kind=kind, digest=digest, status='failed') \
+                .update({'status': 'processing'}, synchronize_session=False)
+            blob = MediaBlob.query.populate_existing().get((digest, kind))
+            return blob, bool(retry)
+
+        try:
+            with db.session.begin_nested():
+                blob = MediaBlob(kind=kind, digest=digest, mime_type=mime_type, ref_count=1)
+                db.session.add(blob)
+            return blob, True
+        except IntegrityError:
+            # a concurrent upload of the same file created it first
+            continue
+
+
+def release_blobs(kind, digests):
+    """
+    Drops one reference per digest (None for media that predates blobs) and
+    queues unreferenced blobs for collection. Runs in the caller's
+    transaction.
+    """
+    from app.models import MediaBlob
+
+    for digest, count in Counter(digest for digest in digests if digest).items():
+        blob = MediaBlob.query.filter_by(kind=kind, digest=digest)
+        blob.update({'ref_count': MediaBlob.ref_count - count}, synchronize_session=False)
+        if blob.with_entities(MediaBlob.ref_count).scalar() == 0:
+            jobs.enqueue('collect_media_blob', blob_kind=kind, digest=digest)
+
+
+PROCESSORS = {'post': 'process_media', 'avatar': 'process_avatar'}
+
+
+class Unstaged(Exception):
+    """The blob needs the file staged, but it looked usable when the upload was checked."""
+
+
+def blob_usable(kind, digest):
+    """Whether a blob for these bytes exists and is ready or being processed, so a repeat needn't be staged."""
+    from app.models import MediaBlob
+
+    return db.session.query(
+        MediaBlob.query.filter(MediaBlob.kind == kind, MediaBlob.digest == digest,
+                               MediaBlob.status != 'failed').exists()
+    ).scalar()
+
+
+def ingest_upload(file_storage, kind, attach):
+    """
+    Hashes an upload, references its blob and calls attach(blob) to add
+    whatever points at it, then commits both together. Only the first copy
+    of a file is staged to S3 and queued for processing; repeats reuse the
+    finished blob, or wait on the one already processing. The hash is taken
+    over the locally spooled upload, so a duplicate never leaves the server.
+
+    Hashing and staging happen before the transaction, which only takes the
+    reference and runs attach, so a slow upload doesn't hold SQLite's write
+    lock. A staged copy that turns out not to be needed is deleted. Returns
+    what attach returned.
+    """
+    mime_type, _ = guess_type(file_storage.filename)
+    if not mime_type:
+        raise ValueError("Could not determine the MIME type")
+
+    digest = content_digest(file_storage.stream)
+    key = None if blob_usable(kind, digest) else stage_upload(file_storage)[0]
+
+    def reference():
+        blob, created = acquire_blob(kind, digest, mime_type)
+        if created:
+            if key is None:
+                raise Unstaged()
+            jobs.enqueue(PROCESSORS[kind], digest=digest, key=key, mime_type=mime_type)
+        return attach(blob), created
+
+    try:
+        while True:
+            try:
+                result, created = commit_with_retry(reference)
+                break
+            except Unstaged:
+                # the blob failed or was collected since it was checked
+                db.session.rollback()
+                key = stage_upload(file_storage)[0]
+    except Exception:
+        db.session.rollback()
+        if key is not None:
+            storage.delete_object(key)
+        raise
+
+    if key is not None and not created:
+        # a concurrent upload of the same file created the blob first
+        storage.delete_object(key)
+    return result
+
+
+def finish_blob(kind, digest, prefix, url, variants):
+    """
+    Marks a blob ready. Returns False, after removing the renditions, if the
+    blob was collected while it was being processed.
+    """
+    from app.models import MediaBlob
+
+    finished = MediaBlob.query.filter_by(kind=kind, digest=digest).update({
+        'status': 'ready', 'prefix': f"{prefix}/", 'url': url, 'variants': variants
+    }, synchronize_session=False)
+    if not finished:
+        db.session.rollback()
+        storage.delete_prefix(f"{prefix}/")
+    return bool(finished)
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def upload_image_derivatives(variants, prefix):
+    """
+    Uploads derivatives under prefix and returns the post's image variants:
+    the intrinsic size of the largest one, a srcset string per format and a
+    fallback src.
+    """
+    srcsets = {}
+    largest = None
+    for width, height, extension, mime_type, buffer in variants:
+        url = storage.stream_upload(buffer, f"{prefix}/{width}.{extension}", mime_type)
+        srcsets.setdefault(extension, []).append(f"{url} {width}w")
+        if largest is None:
+            largest = (width, height)
+        if extension == 'jpg' and width == largest[0]:
+            src = url
+
+    return {
+        'width': largest[0],
+        'height': largest[1],
+        'src': src,
+        'srcset': {extension: ', '.join(reversed(sources)) for extension, sources in srcsets.items()}
+    }
+
+
+def upload_directory(directory, prefix):
+    """Uploads every file under directory to the same relative keys under prefix."""
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            key = f"{prefix}/{os.path.relpath(path, directory).replace(os.sep, '/')}"
+            content_type = CONTENT_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+            with open(path, 'rb') as f:
+                storage.stream_upload(f, key, content_type)
+
+
+def process_video(source, prefix):
+    """
+    Transcodes the progressive mp4 and renders the poster, preview and HLS
+    ladder, then uploads them all under prefix. Returns (mp4 url, video
+    variants).
+    """
+    from app import transcode
+
+    workdir = tempfile.mkdtemp()
+    try:
+        output_path = transcode.transcode_video(source)
+        try:
+            with open(output_path, 'rb') as f:
+                url = storage.stream_upload(f, f"{prefix}/video.mp4", 'video/mp4')
+        finally:
+            discard(output_path)
+
+        width, height = transcode.video_renditions(source, workdir)
+        upload_directory(workdir, prefix)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    base_url = storage.object_url(prefix)
+    return url, {
+        'width': width,
+        'height': height,
+        'poster': f"{base_url}/poster.jpg",
+        'preview': f"{base_url}/preview.mp4",
+        'hls': f"{base_url}/hls/master.m3u8"
+    }
+
+
+@jobs.handler('process_media')
+def process_media(digest, key, mime_type):
+    """Renders a post media blob and fills in every post that uploaded it."""
+    from app import transcode
+    from app.models import MediaBlob, Post
+
+    if MediaBlob.query.get((digest, 'post')) is None:
+        storage.delete_object(key)
+        return
+
+    if mime_type.startswith('video/'):
+        prefix = f"videos/{uuid.uuid4()}"
+        url, video = process_video(storage.presigned_url(key), prefix)
+        variants = {'video': video}
+    else:
+        prefix = f"images/{uuid.uuid4()}"
+        with closing(storage.open_object(key)) as body:
+            original = BytesIO(body.read())
+        image = upload_image_derivatives(transcode.image_derivatives(original), prefix)
+        variants = {'image': image}
+        url = image['src']
+
+    if finish_blob('post', digest, prefix, url, variants):
+        Post.query.filter(Post.media_digest == digest, Post.status != 'ready') \
+            .update({'content': url, 'media_variants': variants, 'status': 'ready', 'version': Post.version + 1},
+                    synchronize_session=False)
+        db.session.commit()
+    storage.delete_object(key)
+
+
+def _mark_failed(digest, key, mime_type):
+    from app.models import MediaBlob, Post
+
+    MediaBlob.query.filter_by(kind='post', digest=digest).update({'status': 'failed'}, synchronize_session=False)
+    Post.query.filter_by(media_digest=digest, status='processing') \
+        .update({'status': 'failed', 'version': Post.version + 1}, synchronize_session=False)
+    storage.delete_object(key)
+
+
+process_media.on_failure = _mark_failed
+
+
+@jobs.handler('process_avatar')
+def process_avatar(digest, key, mime_type):
+    """Crops a profile picture to a small square JPEG and points its users at it."""
+    from app import transcode
+    from app.models import MediaBlob, Post, User
+
+    if MediaBlob.query.get((digest, 'avatar')) is None:
+        storage.delete_object(key)
+        return
+
+    with closing(storage.open_object(key)) as body:
+        original = BytesIO(body.read())
+    buffer = transcode.avatar(original, AVATAR_SIZE)
+
+    prefix = f"avatars/{uuid.uuid4()}"
+    url = storage.stream_upload(buffer, f"{prefix}/{AVATAR_SIZE}.jpg", 'image/jpeg')
+    if finish_blob('avatar', digest, prefix, url, None):
+        User.query.filter_by(avatar_digest=digest).update({'profile_pic': url}, synchronize_session=False)
+        # cards show the author's picture
+        users = select(User.id).where(User.avatar_digest == digest)
+        Post.query.filter(Post.user_id.in_(users)) \
+            .update({'version': Post.version + 1}, synchronize_session=False)
+        db.session.commit()
+    storage.delete_object(key)
+
+
+def _mark_avatar_failed(digest, key, mime_type):
+    from app.models import MediaBlob
+
+    # the users keep the default picture
+    MediaBlob.query.filter_by(kind='avatar', digest=digest).update({'status': 'failed'}, synchronize_session=False)
+    storage.delete_object(key)
+
+
+process_avatar.on_failure = _mark_avatar_failed
+
+
+@jobs.handler('collect_media_blob')
+def collect_media_blob(blob_kind, digest):
+    """Deletes a blob and its renditions if nothing references it any more."""
+    from app.models import MediaBlob
+
+    blob = MediaBlob.query.get((digest, blob_kind))
+    if blob is None or blob.ref_count > 0:
+        return
+
+    prefix = blob.prefix
+    collected = MediaBlob.query.filter_by(kind=blob_kind, digest=digest, ref_count=0).delete(synchronize_session=False)
+    db.session.commit()
+    if collected and prefix:
+        storage.delete_prefix(prefix)
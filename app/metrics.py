@@ -0,0 +1,247 @@
+"""
+Per-request instrumentation: wall time, SQL queries, S3 calls and template
+rendering are timed for every request, aggregated for /metrics in the
+Prometheus text format, and broken down in the log for slow requests.
+Views can declare a query budget; with ENFORCE_QUERY_BUDGETS set, a
+request that goes over it raises QueryBudgetExceeded, which fails the
+request under test. Work whose statement count depends on other requests,
+like an unbuffered flush of the write buffer, waives the budget.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from flask import current_app, g, has_request_context, request
+from flask.signals import before_render_template, signals_available, template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = 500
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.s3_calls = 0
+        self.s3_seconds = 0.0
+        self.template_seconds = 0.0
+        self._template_started = []
+
+    def summary(self, elapsed):
+        return (f'{elapsed * 1000:.0f} ms, {self.queries} queries in {self.query_seconds * 1000:.0f} ms, '
+                f'{self.s3_calls} S3 calls in {self.s3_seconds * 1000:.0f} ms, '
+                f'templates {self.template_seconds * 1000:.0f} ms')
+
+
+def current_stats():
+    """The stats of the request being handled on this thread, if any."""
+    if has_request_context():
+        return g.get('_request_stats')
+    return None
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Registry:
+    """
+    Counters and histograms kept in process. Every worker process has its
+    own, so each one has to be scraped (or a single process run).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+    def counter(self, name, help_text):
+        self._metrics[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._metrics[name] = ('histogram', help_text, buckets)
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        buckets = self._metrics[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts, total, count = self._histograms.get(key, ([0] * len(buckets), 0.0, 0))
+            counts = [seen + (value <= bound) for seen, bound in zip(counts, buckets)]
+            self._histograms[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+
+        lines = []
+        for name, (kind, help_text, buckets) in self._metrics.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{format_labels(labels)} {value:g}')
+                continue
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, seen in zip(buckets, counts):
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", f"{bound:g}"),))} {seen}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {total:g}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+registry = Registry()
+registry.counter('http_requests_total', 'Requests handled, by endpoint, method and status.')
+registry.histogram('http_request_duration_seconds', 'Wall time spent handling requests.', DURATION_BUCKETS)
+registry.histogram('http_request_queries', 'SQL statements issued per request.', QUERY_COUNT_BUCKETS)
+registry.counter('db_query_seconds_total', 'Time spent in SQL statements during requests.')
+registry.counter('s3_calls_total', 'S3 API calls, by operation.')
+registry.counter('s3_call_seconds_total', 'Time spent in S3 API calls, by operation.')
+registry.counter('template_render_seconds_total', 'Time spent rendering templates during requests.')
+registry.counter('slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.')
+
+
+def query_budget(limit):
+    """Declares the most SQL statements a view should need for one request."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g._query_budget = limit
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def waive_query_budget():
+    """Lifts the current request's query budget, for work whose statement count the view doesn't control."""
+    g.pop('_query_budget', None)
+
+
+def _start_request():
+    g._request_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.pop('_request_stats', None)
+    if stats is None:
+        return response
+
+    elapsed = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    registry.inc('http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    registry.observe('http_request_duration_seconds', elapsed, endpoint=endpoint)
+    registry.observe('http_request_queries', stats.queries, endpoint=endpoint)
+    registry.inc('db_query_seconds_total', stats.query_seconds, endpoint=endpoint)
+    registry.inc('template_render_seconds_total', stats.template_seconds, endpoint=endpoint)
+
+    if elapsed * 1000 >= current_app.config['SLOW_REQUEST_MS']:
+        registry.inc('slow_requests_total', endpoint=endpoint)
+        logger.warning('slow request %s %s: %s', request.method, request.full_path.rstrip('?'), stats.summary(elapsed))
+
+    budget = g.get('_query_budget')
+    if budget is not None and stats.queries > budget:
+        message = f'{request.method} {request.path} ran {stats.queries} queries, over its budget of {budget}'
+        if current_app.config['ENFORCE_QUERY_BUDGETS']:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['_query_started'].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_seconds += time.perf_counter() - started
+
+
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get('_query_started'):
+        context.connection.info['_query_started'].pop()
+
+
+def _before_s3_call(context, **kwargs):
+    context['_metrics_started'] = time.perf_counter()
+
+
+def _after_s3_call(context, model, **kwargs):
+    started = context.pop('_metrics_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    registry.inc('s3_calls_total', operation=model.name)
+    registry.inc('s3_call_seconds_total', elapsed, operation=model.name)
+    # multipart parts are sent from transfer threads, outside the request
+    stats = current_stats()
+    if stats is not None:
+        stats.s3_calls += 1
+        stats.s3_seconds += elapsed
+
+
+def _before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats._template_started.append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats._template_started:
+        # included templates render inside their parent, so only count the outermost
+        started = stats._template_started.pop()
+        if not stats._template_started:
+            stats.template_seconds += time.perf_counter() - started
+
+
+def init_app(app, engine, storage):
+    app.config.setdefault('SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+    app.config.setdefault('ENFORCE_QUERY_BUDGETS', False)
+    app.config.setdefault('METRICS_TOKEN', None)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+    storage.add_event_hook('before-parameter-build.s3', _before_s3_call)
+    storage.add_event_hook('after-call.s3', _after_s3_call)
+
+    # Flask only sends signals when blinker is installed
+    if signals_available:
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_after_render, app)
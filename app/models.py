@@ -4,32 +4,52 @@ from flask_wtf import FlaskForm
 from flask_wtf.file import FileAllowed, FileRequired
 from wtforms import StringField, TextAreaField, HiddenField, PasswordField, SubmitField, SelectField, FileField
 from wtforms.validators import InputRequired, Length, ValidationError, Email, EqualTo
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, event, func, or_, select
+from sqlalchemy.orm import joinedload
+from app import db, geo, ranking
+from app.cache import cache
+from app.storage import Base64Reader, storage
 import os
 from dotenv import load_dotenv
-from PIL import Image
 import re
 import datetime
-import base64
-import boto3
 from io import BytesIO
 from mimetypes import guess_type, guess_extension
-import string
-import random
-import moviepy.editor as mp
-
-db = SQLAlchemy()
+import hashlib
 
 load_dotenv()
 
 EXTENSIONS = ["png", "jpg", "jpeg", "mp4"]
-BASE_DIR = os.getcwd()
 S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
 S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-1.amazonaws.com"
 
 STANDARD_IMAGE_SIZE = (800, 800)
 STANDARD_VIDEO_SIZE = (1280, 720)
 
+FEED_PAGE_SIZE = 20
+COMMENT_PAGE_SIZE = 50
+
+# how long cached rows may lag changes made by other processes
+USER_CACHE_TTL = 60
+SPOT_CACHE_TTL = 300
+LIKED_CACHE_TTL = 60
+
+def encode_cursor(row):
+    """Keyset cursor for a row ordered by (timestamp, id)."""
+    return f"{row.timestamp.isoformat()}_{row.id}"
+
+def decode_cursor(cursor):
+    timestamp, _, row_id = cursor.rpartition('_')
+    return datetime.datetime.fromisoformat(timestamp), int(row_id)
+
+def encode_hot_cursor(post):
+    """Keyset cursor for a post in the hot feed, ordered by (hot_score, id)."""
+    return f"{post.hot_score!r}_{post.id}"
+
+def decode_hot_cursor(cursor):
+    score, _, post_id = cursor.rpartition('_')
+    return float(score), int(post_id)
+
 class Asset(db.Model):
     __tablename__ = "asset"
     id = db.Column(db.Integer, primary_key=True)
@@ -51,58 +71,57 @@ class Asset(db.Model):
 
     def create(self, media_data):
         try:
-            media_str = re.sub("^data:image/.+;base64,|^data:video/.+;base64,", "", media_data)
-            media_data = base64.b64decode(media_str)
-            
-            ext = media_data.split(';')[0].split('/')[1]
+            header, _, media_str = media_data.partition(',')
+            match = re.match(r"^data:(?:image|video)/(\w+);base64$", header)
+            if not match:
+                raise Exception("media must be a base64 data URI")
+            ext = match.group(1)
 
             if ext not in EXTENSIONS:
                 raise Exception(f"{ext} is not supported")
 
-            salt = "".join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(16))
+            # named after the content, so re-uploading the same file reuses its object
+            digest = hashlib.sha256()
+            reader = Base64Reader(media_str)
+            for chunk in iter(lambda: reader.read(Base64Reader.BLOCK_SIZE), b''):
+                digest.update(chunk)
+            salt = digest.hexdigest()[:16].upper()
 
             self.base_url = S3_BASE_URL
             self.salt = salt
             self.extension = ext
             self.created_at = datetime.datetime.now()
 
+            existing = Asset.query.filter_by(salt=salt, extension=ext).first()
+            if existing:
+                self.width, self.height = existing.width, existing.height
+                return
+
             media_filename = f"{self.salt}.{self.extension}"
+            media_stream = Base64Reader(media_str)
 
             if ext in ["png", "jpg", "jpeg"]:
-                img = Image.open(BytesIO(media_data))
-                img = img.resize(STANDARD_IMAGE_SIZE, Image.ANTIALIAS)
-                media_buffer = BytesIO()
-                img.save(media_buffer, format=ext.upper())
-                media_data = media_buffer.getvalue()
-                self.width, self.height = STANDARD_IMAGE_SIZE
-
-            elif ext == "mp4":
-                video = mp.VideoFileClip(BytesIO(media_data))
-                video = video.resize(STANDARD_VIDEO_SIZE)
-                media_buffer = BytesIO()
-                video.write_videofile(media_buffer, codec="libx264")
-                media_data = media_buffer.getvalue()
-
-            self.upload(media_data, media_filename)
+                from PIL import Image
+
+                img = Image.open(media_stream)
+                img.thumbnail(STANDARD_IMAGE_SIZE, Image.ANTIALIAS)
+                media_stream = BytesIO()
+                img.save(media_stream, format="JPEG" if ext == "jpg" else ext.upper())
+                media_stream.seek(0)
+                self.width, self.height = img.size
+
+            # videos are decoded and streamed straight through; transcoding
+            # happens in the media worker, not here
+            self.upload(media_stream, media_filename)
 
         except Exception as e:
             print(f"error when creating media: {e}")
 
 
-    def upload(self, media_data, media_filename):
+    def upload(self, media_stream, media_filename):
         try:
-            media_temp_loc = f"{BASE_DIR}/{media_filename}"
-            with open(media_temp_loc, 'wb') as f:
-                f.write(media_data)
-
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(media_temp_loc, S3_BUCKET_NAME, media_filename)
-
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, media_filename)
-            object_acl.put(ACL="public-read")
-
-            os.remove(media_temp_loc)
+            mime_type, _ = guess_type(media_filename)
+            storage.stream_upload(media_stream, media_filename, mime_type)
 
         except Exception as e:
             print(f"error when uploading media: {e}")
@@ -115,10 +134,32 @@ class User(db.Model, UserMixin):
     name = db.Column(db.String(50), nullable=True)
     bio = db.Column(db.Text, nullable=True)
     profile_pic = db.Column(db.String, nullable=True)
-    spots = db.relationship('Spot', backref='user', lazy=True)
-    posts = db.relationship('Post', backref='user', cascade='all, delete-orphan', lazy=True)
-    likes = db.relationship('Like', backref='user', lazy=True)
-    comments = db.relationship('Comment', backref='user', lazy=True)
+    # the MediaBlob the profile picture was made from
+    avatar_digest = db.Column(db.String(64), nullable=True, index=True)
+    spots = db.relationship('Spot', backref='user', lazy=True, passive_deletes=True)
+    posts = db.relationship('Post', backref='user', cascade='all, delete-orphan', lazy=True, passive_deletes=True)
+    likes = db.relationship('Like', backref='user', lazy=True, passive_deletes=True)
+    comments = db.relationship('Comment', backref='user', lazy=True, passive_deletes=True)
+
+    @classmethod
+    def cached(cls, user_id):
+        """
+        Loads a user through the cache, for the per-request session lookup.
+        The cached copy is detached and merged into the current session
+        without a query.
+        """
+        def load():
+            user = cls.query.get(user_id)
+            if user is not None:
+                db.session.expunge(user)
+            return user
+
+        user = cache.get_or_set(f"user:{user_id}", load, ttl=USER_CACHE_TTL)
+        return db.session.merge(user, load=False) if user is not None else None
+
+    @staticmethod
+    def invalidate(user_id):
+        cache.delete(f"user:{user_id}")
 
 class RegisterForm(FlaskForm):
     username = StringField('username', validators=[InputRequired(), Length(min=4, max=20)], render_kw={"placeholder": "username"})
@@ -151,8 +192,76 @@ class Spot(db.Model):
     description = db.Column(db.String(200))
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    posts = db.relationship('Post', backref='spot', lazy=True)
+    geohash = db.Column(db.String(12), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), index=True)
+    posts = db.relationship('Post', backref='spot', lazy=True, passive_deletes=True)
+
+    @classmethod
+    def in_bbox(cls, south, west, north, east):
+        """
+        Query for spots inside the box. The geohash prefix ranges let the
+        index prune candidates before the exact lat/lng comparison.
+        """
+        prefixes = geo.cover(south, west, north, east)
+        query = cls.query.filter(or_(*[geo.prefix_range(cls.geohash, prefix) for prefix in prefixes]))
+        query = query.filter(cls.latitude.between(south, north))
+        if west <= east:
+            return query.filter(cls.longitude.between(west, east))
+        return query.filter(or_(cls.longitude >= west, cls.longitude <= east))
+
+    @classmethod
+    def clusters(cls, south, west, north, east, zoom):
+        """Groups the spots in the box by geohash cell, sized to the zoom level."""
+        cell = func.substr(cls.geohash, 1, geo.cluster_precision(zoom, south, west, north, east))
+        rows = cls.in_bbox(south, west, north, east) \
+            .with_entities(cell, func.count(cls.id), func.avg(cls.latitude), func.avg(cls.longitude)) \
+            .group_by(cell) \
+            .all()
+        return [
+            {'geohash': geohash, 'count': count, 'latitude': latitude, 'longitude': longitude}
+            for geohash, count, latitude, longitude in rows
+        ]
+
+    @classmethod
+    def nearby(cls, latitude, longitude, radius_km=None, limit=20):
+        """
+        Returns up to limit (spot, distance_km) pairs closest to the point.
+        Candidates come from the geohash index for the circle's bounding box
+        and are ranked by exact haversine distance. Without a radius the
+        search widens until it finds limit spots or hits
+        NEARBY_MAX_RADIUS_KM.
+        """
+        radius = radius_km or geo.NEARBY_START_RADIUS_KM
+        max_radius = radius_km or geo.NEARBY_MAX_RADIUS_KM
+
+        while True:
+            candidates = cls.in_bbox(*geo.radius_bbox(latitude, longitude, radius)) \
+                .with_entities(cls.id, cls.latitude, cls.longitude) \
+                .all()
+            ranked = geo.nearest(latitude, longitude, candidates, radius, limit)
+            if len(ranked) >= limit or radius >= max_radius:
+                break
+            radius = min(radius * 2, max_radius)
+
+        spots = {spot.id: spot for spot in cls.query.filter(cls.id.in_([spot_id for spot_id, _ in ranked]))}
+        return [(spots[spot_id], distance) for spot_id, distance in ranked if spot_id in spots]
+
+    @classmethod
+    def choices(cls):
+        """(id, name) for every spot, for the spot dropdowns."""
+        return cache.get_or_set(
+            cache.key('spots', 'choices'),
+            lambda: [tuple(row) for row in cls.query.with_entities(cls.id, cls.name)],
+            ttl=SPOT_CACHE_TTL
+        )
+
+    @staticmethod
+    def invalidate():
+        cache.invalidate('spots')
+
+    @classmethod
+    def latest_id(cls):
+        return db.session.query(func.max(cls.id)).scalar()
 
     def to_dict(self):
         return {
@@ -163,6 +272,11 @@ class Spot(db.Model):
             'longitude': self.longitude
         }
 
+@event.listens_for(Spot, 'before_insert')
+@event.listens_for(Spot, 'before_update')
+def set_spot_geohash(mapper, connection, spot):
+    spot.geohash = geo.encode(float(spot.latitude), float(spot.longitude))
+
 class SpotForm(FlaskForm):
     spot_name = StringField('spot name', validators=[InputRequired(), Length(max=100)])
     description = TextAreaField('description', validators=[InputRequired()])
@@ -181,33 +295,224 @@ class MediaForm(FlaskForm):
 
 class Post(db.Model):
     __tablename__ = "post"
+    # the feeds' sort orders, so each page is a range scan
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_hot_score_id', 'hot_score', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     caption = db.Column(db.String(500), nullable=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    spot_id = db.Column(db.Integer, db.ForeignKey('spot.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    spot_id = db.Column(db.Integer, db.ForeignKey('spot.id', ondelete='SET NULL'), index=True)
     timestamp = db.Column(db.DateTime)
-    likes = db.relationship('Like', backref='post', cascade='all', lazy=True)
-    comments = db.relationship('Comment', backref='post', cascade='all', lazy=True)
+    likes = db.relationship('Like', backref='post', cascade='all', lazy=True, passive_deletes=True)
+    comments = db.relationship('Comment', backref='post', cascade='all', lazy=True, passive_deletes=True)
     media_type = db.Column(db.String(10))
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 'processing' until a worker has uploaded the media, then 'ready' (or 'failed')
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready')
+    # resized renditions of the media, e.g. {'image': {'src', 'srcset', 'width', 'height'}}
+    media_variants = db.Column(db.JSON, nullable=True)
+    # the MediaBlob holding the processed media
+    media_digest = db.Column(db.String(64), nullable=True, index=True)
+    # bumped on every change that shows up in the post's card, so cached cards can be reused until then
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # decaying engagement score the hot feed is ranked by; see app.ranking
+    hot_score = db.Column(db.Float, nullable=False, default=ranking.POST_WEIGHT, server_default='0')
 
     def is_liked_by(self, user):
-        return Like.query.filter_by(post_id=self.id, user_id=user.id).count() > 0   
+        return self.id in Post.liked_ids([self.id], user)
+
+    @staticmethod
+    def liked_ids(post_ids, user):
+        """
+        Returns the subset of post_ids the user has liked. Each post's liked
+        state is cached; the ones that aren't are fetched in one IN query
+        for the whole page rather than one lookup per post.
+        """
+        if not post_ids or not user.is_authenticated:
+            return set()
+
+        keys = {Post.liked_key(user.id, post_id): post_id for post_id in post_ids}
+
+        def load(missing):
+            rows = db.session.query(Like.post_id) \
+                .filter(Like.user_id == user.id, Like.post_id.in_([keys[key] for key in missing])) \
+                .all()
+            liked = {post_id for post_id, in rows}
+            return {key: keys[key] in liked for key in missing}
+
+        found = cache.get_many(keys, load, ttl=LIKED_CACHE_TTL)
+        return {keys[key] for key, liked in found.items() if liked}
+
+    @staticmethod
+    def liked_key(user_id, post_id):
+        return f"liked:{user_id}:{post_id}"
+
+    @staticmethod
+    def remember_liked(user_id, post_id, liked):
+        cache.set(Post.liked_key(user_id, post_id), liked, ttl=LIKED_CACHE_TTL)
+
+    @staticmethod
+    def forget_liked(user_id, post_id):
+        cache.delete(Post.liked_key(user_id, post_id))
+
+    def to_dict(self, liked=False):
+        return {
+            'id': self.id,
+            'content': self.content,
+            'caption': self.caption,
+            'media_type': self.media_type,
+            'status': self.status,
+            'media_variants': self.media_variants,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
+            'user': {
+                'id': self.user.id,
+                'username': self.user.username,
+                'profile_pic': self.user.profile_pic
+            },
+            'spot': {'id': self.spot.id, 'name': self.spot.name} if self.spot else None,
+            'likes': self.like_count,
+            'comments': self.comment_count,
+            'liked': liked
+        }
+
+    encode_cursor = staticmethod(encode_cursor)
+    decode_cursor = staticmethod(decode_cursor)
+
+    @classmethod
+    def feed(cls, cursor=None, limit=FEED_PAGE_SIZE, viewer_id=None):
+        """
+        Returns one page of the newest-first feed and the cursor for the next
+        page. Pages are keyed on (timestamp, id) so each one is an index range
+        scan no matter how deep the client has scrolled. Posts still being
+        processed are only shown to their author. Raises ValueError on a
+        malformed cursor.
+        """
+        query = cls.query.options(joinedload(cls.user), joinedload(cls.spot)) \
+            .filter(or_(cls.status == 'ready', cls.user_id == viewer_id)) \
+            .order_by(cls.timestamp.desc(), cls.id.desc())
+
+        if cursor:
+            timestamp, post_id = cls.decode_cursor(cursor)
+            query = query.filter(or_(
+                cls.timestamp < timestamp,
+                and_(cls.timestamp == timestamp, cls.id < post_id)
+            ))
+
+        posts = query.limit(limit + 1).all()
+        next_cursor = cls.encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+        return posts[:limit], next_cursor
+
+    @classmethod
+    def hot_feed(cls, cursor=None, limit=FEED_PAGE_SIZE, viewer_id=None):
+        """
+        Like feed(), but ranked by hot_score, highest first. Decay shrinks
+        every score between pages, so a page starts below the current score
+        of the post the last one ended on, falling back to the score in the
+        cursor if that post is gone. Raises ValueError on a malformed cursor.
+        """
+        query = cls.query.options(joinedload(cls.user), joinedload(cls.spot)) \
+            .filter(or_(cls.status == 'ready', cls.user_id == viewer_id)) \
+            .order_by(cls.hot_score.desc(), cls.id.desc())
+
+        if cursor:
+            score, post_id = decode_hot_cursor(cursor)
+            anchor = func.coalesce(select(cls.hot_score).where(cls.id == post_id).scalar_subquery(), score)
+            query = query.filter(or_(
+                cls.hot_score < anchor,
+                and_(cls.hot_score == anchor, cls.id < post_id)
+            ))
+
+        posts = query.limit(limit + 1).all()
+        next_cursor = encode_hot_cursor(posts[limit - 1]) if len(posts) > limit else None
+        return posts[:limit], next_cursor
 
 class Like(db.Model):
+    # the unique constraint's index serves lookups by user, this one lookups by post
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='uq_like_user_post'),
+        db.Index('ix_like_post_user', 'post_id', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False)
 
 class Comment(db.Model):
+    __table_args__ = (db.Index('ix_comment_post_timestamp_id', 'post_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(300), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
-    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def page(cls, post_id, cursor=None, limit=COMMENT_PAGE_SIZE):
+        """
+        Returns one page of a post's comments, oldest first, with their
+        authors loaded in the same query, and the cursor for the next page.
+        Raises ValueError on a malformed cursor.
+        """
+        query = cls.query.options(joinedload(cls.user)) \
+            .filter(cls.post_id == post_id) \
+            .order_by(cls.timestamp, cls.id)
+
+        if cursor:
+            timestamp, comment_id = decode_cursor(cursor)
+            query = query.filter(or_(
+                cls.timestamp > timestamp,
+                and_(cls.timestamp == timestamp, cls.id > comment_id)
+            ))
+
+        comments = query.limit(limit + 1).all()
+        next_cursor = encode_cursor(comments[limit - 1]) if len(comments) > limit else None
+        return comments[:limit], next_cursor
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'text': self.text,
+            'timestamp': self.timestamp.isoformat(),
+            'user': {'id': self.user.id, 'username': self.user.username}
+        }
+
+class Job(db.Model):
+    __tablename__ = "job"
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class MediaBlob(db.Model):
+    """
+    A processed upload, keyed by the SHA-256 of the original file and what
+    it was uploaded as ('post' or 'avatar'). Posts and users that upload the
+    same file share one blob; ref_count is how many still point at it.
+    """
+    __tablename__ = "media_blob"
+    digest = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True)
+    mime_type = db.Column(db.String(50), nullable=False)
+    # 'processing' until a worker has uploaded the renditions, then 'ready' (or 'failed')
+    status = db.Column(db.String(20), nullable=False, default='processing')
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    # where the renditions live in S3, so they can be deleted together
+    prefix = db.Column(db.String(100), nullable=True)
+    url = db.Column(db.Text, nullable=True)
+    variants = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
 
 class CommentForm(FlaskForm):
-    text = StringField('comment', validators=[InputRequired()])
+    text = StringField('comment', validators=[InputRequired(), Length(max=300)])
     submit = SubmitField('post comment')
 
 class EmptyForm(FlaskForm):
@@ -0,0 +1,149 @@
+"""
+Checks that the queries behind the hot endpoints are served by indexes.
+
+A throwaway SQLite database is built with the migrations (not create_all,
+so a missing index in a migration is caught too) and seeded with a few
+rows. Each hot endpoint is requested through the test client while every
+statement it runs is recorded, and EXPLAIN QUERY PLAN is run on each one.
+A plan that scans a whole table or sorts in a temporary B-tree is
+reported, as is a request that runs more queries than its view's budget.
+SQLite can't be trusted to pick a scan only when the table is tiny
+without ANALYZE statistics, so none are gathered.
+"""
+import datetime
+import os
+import tempfile
+from contextlib import contextmanager
+from sqlalchemy import event
+from app.metrics import QueryBudgetExceeded
+
+PASSWORD = 'password1'
+
+HOT_REQUESTS = [
+    ('GET', '/dashboard?format=json'),
+    ('GET', '/dashboard'),
+    ('GET', '/dashboard?sort=hot&format=json'),
+    ('GET', '/dashboard?sort=hot&format=json&cursor=1.0_1'),
+    ('GET', '/api/posts/1/status'),
+    ('POST', '/like_post/1'),
+    ('GET', '/comments/1'),
+    ('POST', '/comments/1', {'text': 'nice line'}),
+    ('GET', '/api/posts/1/comments'),
+    ('GET', '/api/posts/1/comments?cursor=2000-01-01T00:00:00_1'),
+    ('POST', '/api/posts/1/comments', {'text': 'nice line'}),
+    ('GET', '/api/spots?bbox=40.6,-74.1,40.8,-73.9&zoom=16'),
+    ('GET', '/api/spots?bbox=40.6,-74.1,40.8,-73.9&zoom=8'),
+    ('GET', '/api/spots/nearby?lat=40.7&lng=-74.0&radius=5'),
+    ('GET', '/search_posts?query=kickflip'),
+]
+
+
+def plan_problems(plan):
+    """The steps of an EXPLAIN QUERY PLAN that read a whole table or sort without an index."""
+    # full-text matches are ranked by relevance, which no index can presort
+    ranked = any('VIRTUAL TABLE' in detail for detail in plan)
+    problems = []
+    for detail in plan:
+        if detail.startswith('SCAN ') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail \
+                and not detail.startswith('SCAN CONSTANT ROW'):
+            problems.append(detail)
+        elif 'USE TEMP B-TREE FOR ORDER BY' in detail and not ranked:
+            problems.append(detail)
+    return problems
+
+
+@contextmanager
+def recorded_statements(engine):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def seed():
+    from app import bcrypt, db
+    from app.models import Comment, Like, Post, Spot, User
+
+    password = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+    users = [User(username=f'skater{i}', email=f'skater{i}@example.com', password=password) for i in range(3)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    spots = [
+        Spot(name=f'ledge {i}', description='kickflip spot', latitude=40.7 + i / 100,
+             longitude=-74.0 + i / 100, user_id=users[i % 3].id)
+        for i in range(5)
+    ]
+    db.session.add_all(spots)
+    db.session.flush()
+
+    now = datetime.datetime.utcnow()
+    posts = [
+        Post(content=f'https://example.com/{i}.jpg', caption=f'kickflip {i}', media_type='image',
+             user_id=users[i % 3].id, spot_id=spots[i % 5].id, timestamp=now - datetime.timedelta(minutes=i))
+        for i in range(30)
+    ]
+    db.session.add_all(posts)
+    db.session.flush()
+
+    db.session.add_all(Like(user_id=users[1].id, post_id=post.id) for post in posts[1:10])
+    db.session.add_all(
+        Comment(text='sick', user_id=users[i % 3].id, post_id=posts[i % 4].id, timestamp=now)
+        for i in range(12)
+    )
+    db.session.commit()
+    return users[0].username
+
+
+def check_query_plans():
+    """
+    Runs the hot endpoints against a fresh migrated database, with query
+    budgets enforced. Returns a list of (request, statement, problems) for
+    every query that scans or sorts and every request over its budget.
+    """
+    from flask_migrate import upgrade
+    from app import create_app, db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'plans.db')}",
+            'TESTING': True,
+            'WTF_CSRF_ENABLED': False,
+            'ENFORCE_QUERY_BUDGETS': True,
+            # likes and comments are written inside the request, so their queries are checked too
+            'WRITE_BUFFER_MS': 0
+        })
+        failures = []
+        with app.app_context():
+            upgrade()
+            username = seed()
+
+            client = app.test_client()
+            client.post('/login', data={'username': username, 'password': PASSWORD})
+
+            for method, url, *data in HOT_REQUESTS:
+                with recorded_statements(db.engine) as statements:
+                    try:
+                        response = client.open(url, method=method, data=data[0] if data else None)
+                    except QueryBudgetExceeded as e:
+                        failures.append((f'{method} {url}', str(e), ['over query budget']))
+                        continue
+                if response.status_code >= 400:
+                    raise RuntimeError(f'{method} {url} returned {response.status_code}')
+
+                connection = db.session.connection()
+                for statement, parameters in statements:
+                    plan = [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+                    problems = plan_problems(plan)
+                    if problems:
+                        failures.append((f'{method} {url}', ' '.join(statement.split()), problems))
+            db.session.remove()
+            db.engine.dispose()
+        return failures
@@ -0,0 +1,56 @@
+"""
+Scores for the hot feed. A post's score is the weight of its own creation,
+its likes and its comments, each halving every HALF_LIFE. Likes and
+comments add their weight to the stored score as they happen, and a
+periodic job decays every warm score at once. Decay scales all scores
+alike, so their order holds between runs and the feed reads them straight
+off the (hot_score, id) index.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import case
+from app import db, jobs
+
+HALF_LIFE = timedelta(hours=12)
+DECAY_INTERVAL = timedelta(minutes=10)
+
+POST_WEIGHT = 3.0
+LIKE_WEIGHT = 1.0
+COMMENT_WEIGHT = 2.0
+
+# scores that decay below this drop to 0 and the job stops rewriting them;
+# the hot feed lists those posts newest first
+FLOOR = 0.05
+
+
+def decay_factor(elapsed):
+    return 0.5 ** (elapsed / HALF_LIFE)
+
+
+def bumped(score, weight):
+    """SQL for score plus weight, which removing a like or comment can't take below 0."""
+    return case((score + weight > 0, score + weight), else_=0.0)
+
+
+def estimate(timestamp, likes, comments, now):
+    """
+    A score for a post whose likes and comments are only known as counts,
+    decayed as if they all came in when it was posted.
+    """
+    if timestamp is None:
+        return 0.0
+    weight = POST_WEIGHT + LIKE_WEIGHT * likes + COMMENT_WEIGHT * comments
+    score = weight * decay_factor(max(now - timestamp, timedelta(0)))
+    return score if score >= FLOOR else 0.0
+
+
+@jobs.periodic('decay_hot_scores', DECAY_INTERVAL)
+def decay_hot_scores(last_run=None):
+    """Decays every warm score by the time since the last run."""
+    from app.models import Post
+
+    elapsed = datetime.utcnow() - datetime.fromisoformat(last_run) if last_run else DECAY_INTERVAL
+    factor = decay_factor(elapsed)
+    Post.query.filter(Post.hot_score > 0) \
+        .update({Post.hot_score: case((Post.hot_score * factor >= FLOOR, Post.hot_score * factor), else_=0.0)},
+                synchronize_session=False)
+    db.session.commit()
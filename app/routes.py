@@ -1,16 +1,21 @@
-from flask import Blueprint, render_template, url_for, redirect, flash, make_response, request, jsonify
+from flask import Blueprint, Response, current_app, render_template, url_for, redirect, flash, make_response, request, jsonify, abort
 from flask_login import login_user, login_required, logout_user, current_user
 from app import db, bcrypt  
-from app.models import User, RegisterForm, LoginForm, Spot, SpotForm, MediaForm, Post, Comment, Like, CommentForm, EmptyForm
+from app.models import User, RegisterForm, LoginForm, Spot, SpotForm, MediaForm, Post, Comment, Like, CommentForm, EmptyForm, SPOT_CACHE_TTL
+from app import search, geo, media, deletion, live, metrics
+from app.ingest import RateLimited, limiter, writes
+from app.fragments import render_post_cards
+from app.conditional import make_etag, page_etag, not_modified, validated
+from app.database import commit_with_retry
+from app.storage import storage
+from app.cache import cache
+import hmac
+import math
 import os
 from dotenv import load_dotenv
-import boto3
-from mimetypes import guess_type
-import uuid
-import time
-from sqlalchemy.exc import OperationalError, PendingRollbackError
+from sqlalchemy.exc import OperationalError
 import logging
-from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 from datetime import datetime
 
 
@@ -35,10 +40,7 @@ def login():
         if user and bcrypt.check_password_hash(user.password, form.password.data):
             login_user(user)
             flash('logged in successfully!', 'success')
-
-            posts = Post.query.order_by(Post.timestamp.desc()).all()
-            posts.reverse()
-            return redirect(url_for('main.dashboard', posts=posts))
+            return redirect(url_for('main.dashboard'))
         else:
             flash('login failed. please check username and password.', 'danger')
     return render_template('login.html', form=form)
@@ -58,18 +60,23 @@ def register():
 
         if not form.profile_pic.data:
             new_user.profile_pic = '/static/default_pfp.jpg'
+            db.session.add(new_user)
+            db.session.commit()
         
         else:
-            profile_pic_url = upload_to_s3(form.profile_pic.data)
-            if profile_pic_url:
-                new_user.profile_pic = profile_pic_url
-            else:
+            def attach(avatar):
+                new_user.avatar_digest = avatar.digest
+                # the default is shown until the worker has made the cropped thumbnail
+                new_user.profile_pic = avatar.url if avatar.status == 'ready' else '/static/default_pfp.jpg'
+                db.session.add(new_user)
+
+            try:
+                media.ingest_upload(form.profile_pic.data, 'avatar', attach)
+            except Exception as e:
+                logger.error(f'error staging profile picture: {e}')
                 flash('Failed to upload profile picture. Please try again.', 'danger')
                 return render_template('register.html', form=form)
 
-        db.session.add(new_user)
-        db.session.commit()
-
         flash('Your account has been created!', 'success')
         login_user(new_user)
         return redirect(url_for('main.dashboard'))
@@ -90,21 +97,45 @@ def profile():
 
 @main.route('/dashboard')
 @login_required
+@metrics.query_budget(6)
 def dashboard():
-    posts = Post.query.order_by(Post.timestamp.desc()).all()
-    posts.reverse()
+    sort = 'hot' if request.args.get('sort') == 'hot' else 'new'
+    feed = Post.hot_feed if sort == 'hot' else Post.feed
+    try:
+        posts, next_cursor = feed(cursor=request.args.get('cursor'), viewer_id=current_user.id)
+    except ValueError:
+        abort(400)
+    liked_ids = Post.liked_ids([post.id for post in posts], current_user)
+
+    # a page changes when one of its posts does (version) or the viewer likes one
+    versions = [(post.id, post.version) for post in posts]
+    as_json = request.args.get('format') == 'json'
+    if as_json:
+        etag = make_etag('feed', sort, current_user.id, versions, sorted(liked_ids), next_cursor)
+    else:
+        etag = page_etag('dashboard', sort, current_user.id, versions, sorted(liked_ids), next_cursor)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
+    if as_json:
+        return validated(jsonify({
+            'posts': [post.to_dict(liked=post.id in liked_ids) for post in posts],
+            'html': render_post_cards(posts),
+            'liked_ids': sorted(liked_ids),
+            'next_cursor': next_cursor
+        }), etag)
+
     form = EmptyForm()
-    return render_template('dashboard.html', posts=posts, form=form)
+    return validated(render_template('dashboard.html', posts=posts, form=form, liked_ids=liked_ids, next_cursor=next_cursor, sort=sort), etag)
 
 @main.route('/delete_profile', methods=['POST'])
 @login_required
 def delete_profile():
-    user = User.query.get(current_user.id)
-    if user:
-        user = db.session.merge(user)
+    user_id = current_user.id
+    if commit_with_retry(lambda: deletion.delete_user(user_id)):
         logout_user()
-        db.session.delete(user)
-        commit_session_with_retry(db.session)
+        User.invalidate(user_id)
         flash('your profile has been deleted.', 'success')
     else:
         flash('user not found.', 'danger')
@@ -123,9 +154,71 @@ def logout():
 @main.route('/spot_map')
 @login_required
 def spot_map():
-    skate_spots = Spot.query.all()
-    skate_spots_dict = [spot.to_dict() for spot in skate_spots]
-    return render_template('spot_map.html', skate_spots=skate_spots_dict, maps_key=maps_key)
+    # the page is static; spots arrive through /api/spots
+    etag = make_etag('spot_map', maps_key)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+    return validated(render_template('spot_map.html', maps_key=maps_key), etag)
+
+@main.route('/api/spots')
+@login_required
+@metrics.query_budget(4)
+def spots_in_viewport():
+    try:
+        south, west, north, east = geo.parse_bbox(request.args.get('bbox', ''))
+    except ValueError:
+        abort(400)
+    zoom = request.args.get('zoom', geo.CLUSTER_MAX_ZOOM, type=int)
+
+    def load():
+        if zoom < geo.CLUSTER_MAX_ZOOM:
+            return {'zoom': zoom, 'clusters': Spot.clusters(south, west, north, east, zoom), 'spots': []}
+
+        spots = Spot.in_bbox(south, west, north, east).limit(geo.MAX_VIEWPORT_SPOTS + 1).all()
+        return {
+            'zoom': zoom,
+            'clusters': [],
+            'spots': [spot.to_dict() for spot in spots[:geo.MAX_VIEWPORT_SPOTS]],
+            'truncated': len(spots) > geo.MAX_VIEWPORT_SPOTS
+        }
+
+    # spots are only ever added, so the newest id versions every viewport
+    etag = make_etag('spots', Spot.latest_id(), south, west, north, east, zoom)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
+    # everyone opening the map starts from the same view, so repeats are common
+    key = cache.key('spots', 'viewport', south, west, north, east, zoom)
+    return validated(jsonify(cache.get_or_set(key, load, ttl=SPOT_CACHE_TTL)), etag)
+
+@main.route('/api/spots/nearby')
+@login_required
+# every radius search, plus the user, the latest spot id and the spots themselves
+@metrics.query_budget(geo.NEARBY_MAX_PASSES + 3)
+def nearby_spots():
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lng', type=float)
+    radius_km = request.args.get('radius', type=float)
+    limit = request.args.get('limit', 20, type=int)
+
+    if latitude is None or longitude is None or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        abort(400)
+    if radius_km is not None and not (0 < radius_km <= geo.NEARBY_MAX_RADIUS_KM):
+        abort(400)
+    if not 1 <= limit <= 100:
+        abort(400)
+
+    etag = make_etag('nearby', Spot.latest_id(), latitude, longitude, radius_km, limit)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
+    nearby = Spot.nearby(latitude, longitude, radius_km=radius_km, limit=limit)
+    return validated(jsonify({
+        'spots': [dict(spot.to_dict(), distance_km=round(distance, 3)) for spot, distance in nearby]
+    }), etag)
 
 @main.route('/post_spot', methods=['GET', 'POST'])
 @login_required
@@ -133,15 +226,17 @@ def post_spot():
     form = SpotForm()
 
     if form.validate_on_submit():
-        new_spot = Spot(
-            name=form.spot_name.data,
-            description=form.description.data,
-            latitude=form.latitude.data,
-            longitude=form.longitude.data,
-            user_id=current_user.id
-        )
-        db.session.add(new_spot)
-        commit_session_with_retry(db.session)
+        def add_spot():
+            db.session.add(Spot(
+                name=form.spot_name.data,
+                description=form.description.data,
+                latitude=form.latitude.data,
+                longitude=form.longitude.data,
+                user_id=current_user.id
+            ))
+
+        commit_with_retry(add_spot)
+        Spot.invalidate()
         flash('new spot added!', 'success')
         return redirect(url_for('main.dashboard'))
 
@@ -156,7 +251,7 @@ def post_spot():
 @login_required
 def create_media():
     form = MediaForm()
-    form.associated_spot.choices = [('0', 'select a spot')] + [(spot.id, spot.name) for spot in Spot.query.all()]
+    form.associated_spot.choices = [('0', 'select a spot')] + Spot.choices()
 
     if form.validate_on_submit():
         media_file = form.media.data 
@@ -164,25 +259,32 @@ def create_media():
         associated_spot_id = form.associated_spot.data
 
         if media_file:
+            def publish(blob):
+                # a file that was uploaded before is ready straight away
+                post = Post(
+                    content=blob.url or '',
+                    caption=caption,
+                    user_id=current_user.id,
+                    spot_id=associated_spot_id or None,
+                    timestamp=datetime.utcnow(),
+                    media_type=blob.mime_type.split('/')[0],
+                    media_digest=blob.digest,
+                    media_variants=blob.variants,
+                    status=blob.status
+                )
+                db.session.add(post)
+                return post
+
             try:
-                media_url = upload_to_s3(media_file)
-
-                if media_url:
-                    new_post = Post(
-                        content=media_url,
-                        caption=caption,
-                        user_id=current_user.id,
-                        spot_id=associated_spot_id,
-                        timestamp=datetime.utcnow()
-                    )
-                    db.session.add(new_post)
-                    commit_session_with_retry(db.session)
-                    flash('posted!', 'success')
-                    return redirect(url_for('main.dashboard'))
-                else:
-                    flash('failed to upload media. please try again.', 'danger')
+                new_post = media.ingest_upload(media_file, 'post', publish)
             except Exception as e:
                 flash(f'error uploading media: {str(e)}', 'danger')
+            else:
+                if new_post.status == 'ready':
+                    flash('posted!', 'success')
+                else:
+                    flash('posted! your media is processing.', 'success')
+                return redirect(url_for('main.dashboard'))
 
     if form.errors:
         for fieldName, errorMessages in form.errors.items():
@@ -191,73 +293,134 @@ def create_media():
 
     return render_template('create_post.html', form=form)
 
-s3 = boto3.client('s3')
-
-STANDARD_IMAGE_SIZE = (800, 800)
-STANDARD_VIDEO_SIZE = (1280, 720)
-
-def upload_to_s3(file_obj):
-    try:
-        file_name = str(uuid.uuid4())
-        mime_type, _ = guess_type(file_obj.filename)
-        if not mime_type:
-            raise ValueError("Could not determine the MIME type")
-
-        file_extension = mime_type.split('/')[1]
-        s3_key = f"{file_name}.{file_extension}"
-
-        s3 = boto3.client('s3')
-        s3.upload_fileobj(
-            file_obj,
-            os.getenv('S3_BUCKET_NAME'), 
-            s3_key,
-            ExtraArgs={
-                'ACL': 'public-read',
-                'ContentType': mime_type
-            }
-        )
-
-        file_url = f"https://{os.getenv('S3_BUCKET_NAME')}.s3.amazonaws.com/{s3_key}"
-        return file_url
-
-    except Exception as e:
-        print(f"Error uploading file to S3: {e}")
-        return None
+@main.route('/api/posts/<int:post_id>/status')
+@login_required
+@metrics.query_budget(4)
+def post_status(post_id):
+    post = Post.query.get_or_404(post_id)
+    if post.status != 'ready' and post.user_id != current_user.id:
+        abort(404)
+
+    liked = post.id in Post.liked_ids([post.id], current_user)
+    etag = make_etag('post_status', post.id, post.version, post.status, liked)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
+    response = {'id': post.id, 'status': post.status}
+    if post.status == 'ready':
+        response['html'] = render_post_cards([post])
+        response['liked'] = liked
+    return validated(jsonify(response), etag)
+
+def too_many_requests(error, body):
+    response = jsonify(body)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
 
 @main.route('/like_post/<int:post_id>', methods=['POST'])
 @login_required
+@metrics.query_budget(6)
 def like_post(post_id):
-    post = Post.query.get_or_404(post_id)
-
-    if post.is_liked_by(current_user):
-        like = Like.query.filter_by(user_id=current_user.id, post_id=post_id).first()
-        like = db.session.merge(like)
-        db.session.delete(like)
-        liked = False
-    else:
-        like = Like(user_id=current_user.id, post_id=post_id)
-        db.session.add(like)
-        liked = True
-
-    commit_session_with_retry(db.session)
-    return jsonify({'likes': len(post.likes), 'liked': liked})
+    try:
+        limiter.check('like', current_user.id)
+    except RateLimited as e:
+        return too_many_requests(e, {'error': 'you are liking too fast, try again in a moment.'})
+
+    # answered with the count the like will make; it's written with the next batch
+    result = writes.toggle_like(current_user, post_id)
+    if result is None:
+        abort(404)
+    writes.after_write()
+    liked, like_count = result
+
+    live.broker.publish_likes(post_id, like_count)
+    response = jsonify({'likes': like_count, 'liked': liked})
+    response.cache_control.no_store = True
+    return response
 
 @main.route('/comments/<int:post_id>', methods=['GET', 'POST'])
 @login_required
+@metrics.query_budget(6)
 def comments(post_id):
     post = Post.query.get_or_404(post_id)
     form = CommentForm()
 
     if form.validate_on_submit():
-        comment = Comment(text=form.text.data, user_id=current_user.id, post_id=post.id)
-        db.session.add(comment)
-        commit_session_with_retry(db.session)
+        try:
+            limiter.check('comment', current_user.id)
+        except RateLimited:
+            flash('you are commenting too fast, try again in a moment.', 'danger')
+            return redirect(url_for('main.comments', post_id=post_id))
+        comment = writes.add_comment(current_user, post_id, form.text.data)
+        writes.after_write()
+        try:
+            comment.wait()
+        except LookupError:
+            abort(404)
+        except TimeoutError:
+            flash('your comment is taking a while to post, check back in a moment.', 'danger')
+            return redirect(url_for('main.comments', post_id=post_id))
         flash('comment posted!', 'success')
         return redirect(url_for('main.comments', post_id=post_id))
 
-    comments = Comment.query.filter_by(post_id=post_id).all()
+    # every new comment bumps the post's version
+    etag = page_etag('comments', post.id, post.version, post.caption)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
+    comments, next_cursor = Comment.page(post_id)
+
+    return validated(render_template('comments.html', post=post, form=form, comments=comments, next_cursor=next_cursor), etag)
+
+@main.route('/api/posts/<int:post_id>/comments', methods=['GET', 'POST'])
+@login_required
+@metrics.query_budget(6)
+def comments_api(post_id):
+    post = Post.query.get_or_404(post_id)
+
+    if request.method == 'POST':
+        form = CommentForm()
+        if not form.validate():
+            return jsonify({'errors': form.errors}), 400
+        try:
+            limiter.check('comment', current_user.id)
+        except RateLimited as e:
+            return too_many_requests(e, {'errors': {'text': ['you are commenting too fast, try again in a moment.']}})
+        # read before waiting, which gives up the session
+        comment_count = post.comment_count + 1
+        comment = writes.add_comment(current_user, post_id, form.text.data)
+        writes.after_write()
+        try:
+            comment.wait()
+        except LookupError:
+            abort(404)
+        except TimeoutError:
+            # it may still be written, so the client shouldn't simply post it again
+            response = jsonify({'errors': {'text': ['your comment is taking a while to post, check back in a moment.']}})
+            response.status_code = 503
+            return response
+        response = jsonify({'comment': comment.to_dict(), 'comments': comment_count})
+        response.status_code = 201
+        response.cache_control.no_store = True
+        return response
+
+    cursor = request.args.get('cursor')
+    etag = make_etag('comments', post.id, post.version, cursor)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
 
-    return render_template('comments.html', post=post, form=form, comments=comments)
+    try:
+        comments, next_cursor = Comment.page(post_id, cursor=cursor)
+    except ValueError:
+        abort(400)
+    return validated(jsonify({
+        'comments': [comment.to_dict() for comment in comments],
+        'next_cursor': next_cursor
+    }), etag)
 
 
 @main.route('/delete_post/<int:post_id>', methods=['POST'])
@@ -268,21 +431,61 @@ def delete_post(post_id):
         flash('you do not have permission to delete this post.', 'danger')
         return redirect(url_for('main.dashboard'))
 
-    post = db.session.merge(post)
-    db.session.delete(post)
-    
     try:
-        commit_session_with_retry(db.session)
+        commit_with_retry(lambda: deletion.delete_post(post_id))
+        Post.forget_liked(current_user.id, post_id)
         flash('post deleted.', 'success')
     except OperationalError:
         flash('an error occurred while deleting the post. please try again.', 'danger')
-    
-    posts = Post.query.order_by(Post.timestamp.desc()).all()
-    posts.reverse()
-    return redirect(url_for('main.dashboard', posts=posts))
+
+    return redirect(url_for('main.dashboard'))
+
+@main.route('/api/live')
+@login_required
+def live_updates():
+    post_ids = live.parse_post_ids(request.args.get('posts'))
+    # EventSource sends the header when it reconnects by itself; the page
+    # passes the parameter when it reopens the stream for a new set of posts
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('last_event_id', type=int)
+    response = Response(live.event_stream(post_ids, last_event_id), mimetype='text/event-stream')
+    response.cache_control.no_store = True
+    # stop nginx holding events back until its buffer fills
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@main.route('/api/live/poll')
+@login_required
+def live_poll():
+    post_ids = live.parse_post_ids(request.args.get('posts'))
+    events, last_id = live.long_poll(post_ids, request.args.get('last_event_id', type=int))
+    response = jsonify({'events': events, 'last_event_id': last_id})
+    response.cache_control.no_store = True
+    return response
+
+@main.route('/api/cache_stats')
+@login_required
+def cache_stats():
+    response = jsonify(cache.stats())
+    response.cache_control.no_store = True
+    return response
+
+@main.route('/metrics')
+def prometheus_metrics():
+    # scrapers can't log in; set METRICS_TOKEN to require it as a bearer token
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    response = make_response(metrics.registry.render())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.cache_control.no_store = True
+    return response
 
 @main.route('/search_posts', methods=['POST', 'GET'])
 @login_required
+@metrics.query_budget(6)
 def search_posts():
     if request.method == 'POST':
         query = request.form.get('query')
@@ -293,30 +496,16 @@ def search_posts():
         flash("Please enter a search term.", "danger")
         return redirect(url_for('main.dashboard'))
 
-    keywords = query.split()
-  
-    search_conditions = [Post.caption.ilike(f'%{keyword}%') for keyword in keywords]
-
-    
-    matched_posts = Post.query.filter(or_(*search_conditions)).all()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400)
+    matched_posts, results_count = search.search_posts(query, page=page)
 
     form = EmptyForm()
     if matched_posts:
-        return render_template('dashboard.html', posts=matched_posts, form=form, results_count=len(matched_posts), query=query)
+        liked_ids = Post.liked_ids([post.id for post in matched_posts], current_user)
+        next_page = page + 1 if page * search.SEARCH_PAGE_SIZE < results_count else None
+        return render_template('dashboard.html', posts=matched_posts, form=form, liked_ids=liked_ids, results_count=results_count, query=query, next_page=next_page)
     else:
         flash('No matching posts found.', 'warning')
         return redirect(url_for('main.dashboard'))
-    
-def commit_session_with_retry(session, retries=5, delay=1):
-    for attempt in range(retries):
-        try:
-            session.commit()
-            break
-        except OperationalError as e:
-            if 'database is locked' in str(e):
-                time.sleep(delay)
-            else:
-                raise
-        except PendingRollbackError:
-            session.rollback()
-            time.sleep(delay)
@@ -0,0 +1,158 @@
+import re
+from sqlalchemy import event, or_, text
+from sqlalchemy.orm import joinedload
+from app import db
+
+SEARCH_PAGE_SIZE = 20
+
+# column weights for bm25(), in post_search column order
+RANK_WEIGHTS = (4.0, 2.0, 1.0, 2.0)
+
+SEARCH_INDEX_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(
+        caption, spot_name, spot_description, username,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_insert AFTER INSERT ON post BEGIN
+        INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+        VALUES (
+            new.id,
+            new.caption,
+            (SELECT name FROM spot WHERE id = new.spot_id),
+            (SELECT description FROM spot WHERE id = new.spot_id),
+            (SELECT username FROM "user" WHERE id = new.user_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_update AFTER UPDATE OF caption, spot_id, user_id ON post BEGIN
+        DELETE FROM post_search WHERE rowid = old.id;
+        INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+        VALUES (
+            new.id,
+            new.caption,
+            (SELECT name FROM spot WHERE id = new.spot_id),
+            (SELECT description FROM spot WHERE id = new.spot_id),
+            (SELECT username FROM "user" WHERE id = new.user_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_delete AFTER DELETE ON post BEGIN
+        DELETE FROM post_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_spot_update AFTER UPDATE OF name, description ON spot BEGIN
+        UPDATE post_search SET spot_name = new.name, spot_description = new.description
+        WHERE rowid IN (SELECT id FROM post WHERE spot_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_user_update AFTER UPDATE OF username ON "user" BEGIN
+        UPDATE post_search SET username = new.username
+        WHERE rowid IN (SELECT id FROM post WHERE user_id = new.id);
+    END
+    """
+]
+
+REBUILD_SQL = """
+    INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+    SELECT post.id, post.caption, spot.name, spot.description, "user".username
+    FROM post
+    LEFT JOIN spot ON spot.id = post.spot_id
+    LEFT JOIN "user" ON "user".id = post.user_id
+"""
+
+
+def fts_enabled(bind):
+    return bind.dialect.name == 'sqlite'
+
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    if not fts_enabled(connection):
+        return
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(text(statement))
+
+
+def rebuild_search_index():
+    """
+    Repopulates post_search from the post, spot and user tables. Returns the
+    number of indexed posts.
+    """
+    connection = db.session.connection()
+    create_search_index(db.metadata, connection)
+    connection.execute(text("DELETE FROM post_search"))
+    indexed = connection.execute(text(REBUILD_SQL)).rowcount
+    connection.execute(text("INSERT INTO post_search (post_search) VALUES ('optimize')"))
+    db.session.commit()
+    return indexed
+
+
+def to_match_query(query):
+    """
+    Turns free text into an FTS5 query that ORs a prefix match for every
+    token, split the way the unicode61 tokenizer splits them, so
+    "skate-park" searches for "skate" and "park". Returns None if nothing
+    searchable is left.
+    """
+    # unicode61 treats underscores as separators too
+    terms = re.findall(r'[^\W_]+', query)
+    if not terms:
+        return None
+    return ' OR '.join(f'"{term}"*' for term in terms)
+
+
+def search_posts(query, page=1, per_page=SEARCH_PAGE_SIZE):
+    """
+    Returns (posts, total) for one page of posts matching the query, best
+    match first.
+    """
+    from app.models import Post
+
+    match = to_match_query(query)
+    if match is None:
+        return [], 0
+
+    offset = (page - 1) * per_page
+
+    if not fts_enabled(db.engine):
+        conditions = [Post.caption.ilike(f'%{keyword}%') for keyword in query.split()]
+        matches = Post.query.filter(or_(*conditions), Post.status == 'ready')
+        posts = matches.options(joinedload(Post.user), joinedload(Post.spot)) \
+            .order_by(Post.timestamp.desc()) \
+            .limit(per_page).offset(offset).all()
+        return posts, matches.count()
+
+    # only ready posts are listed, so they're filtered before paging and counting
+    total = db.session.execute(
+        text("""
+            SELECT count(*) FROM post_search
+            JOIN post ON post.id = post_search.rowid
+            WHERE post_search MATCH :match AND post.status = 'ready'
+        """),
+        {'match': match}
+    ).scalar()
+
+    weights = ', '.join(str(weight) for weight in RANK_WEIGHTS)
+    rows = db.session.execute(
+        text(f"""
+            SELECT post_search.rowid FROM post_search
+            JOIN post ON post.id = post_search.rowid
+            WHERE post_search MATCH :match AND post.status = 'ready'
+            ORDER BY bm25(post_search, {weights})
+            LIMIT :limit OFFSET :offset
+        """),
+        {'match': match, 'limit': per_page, 'offset': offset}
+    )
+    post_ids = [post_id for post_id, in rows]
+
+    posts = Post.query.options(joinedload(Post.user), joinedload(Post.spot)) \
+        .filter(Post.id.in_(post_ids)).all()
+    by_id = {post.id: post for post in posts}
+    return [by_id[post_id] for post_id in post_ids if post_id in by_id], total
@@ -0,0 +1,178 @@
+import base64
+import io
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# S3 needs every part but the last to be at least 5 MB
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+def read_chunk(stream, size):
+    """Reads up to size bytes, looping over short reads from sockets and pipes."""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+class Base64Reader(io.RawIOBase):
+    """Read-only stream that decodes a base64 string a block at a time."""
+
+    # a multiple of 4 so every block decodes on its own
+    BLOCK_SIZE = 4 * 256 * 1024
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self.position = 0
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.pending) + len(self.encoded) - self.position
+        while len(self.pending) < size and self.position < len(self.encoded):
+            block = self.encoded[self.position:self.position + self.BLOCK_SIZE]
+            self.pending += base64.b64decode(block)
+            self.position += self.BLOCK_SIZE
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+class Storage:
+    """
+    The app's single way to talk to S3. It owns one client, built on first
+    use from a private boto3 session. Clients are thread-safe, so every
+    request thread and upload shares its connection pool and adaptive retry
+    state instead of re-reading credentials and opening new TLS connections
+    per upload.
+    """
+
+    def __init__(self, bucket=None, endpoint_url=None, max_pool_connections=50, max_attempts=5, client=None):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.max_pool_connections = max_pool_connections
+        self.max_attempts = max_attempts
+        self._client = client
+        self._lock = threading.Lock()
+        # (event name, handler) pairs registered on the client when it's built
+        self.event_hooks = []
+
+    def init_app(self, app):
+        app.config.setdefault('S3_BUCKET_NAME', os.getenv('S3_BUCKET_NAME'))
+        app.config.setdefault('S3_ENDPOINT_URL', os.getenv('S3_ENDPOINT_URL'))
+        app.config.setdefault('S3_MAX_POOL_CONNECTIONS', self.max_pool_connections)
+        app.config.setdefault('S3_MAX_ATTEMPTS', self.max_attempts)
+
+        self.bucket = app.config['S3_BUCKET_NAME']
+        self.endpoint_url = app.config['S3_ENDPOINT_URL']
+        self.max_pool_connections = app.config['S3_MAX_POOL_CONNECTIONS']
+        self.max_attempts = app.config['S3_MAX_ATTEMPTS']
+        app.extensions['storage'] = self
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # boto3 takes a tenth of a second to import, which only
+                    # the requests that reach S3 should pay
+                    import boto3
+                    from botocore.config import Config
+
+                    config = Config(
+                        max_pool_connections=self.max_pool_connections,
+                        retries={'max_attempts': self.max_attempts, 'mode': 'adaptive'}
+                    )
+                    client = boto3.session.Session().client(
+                        's3', endpoint_url=self.endpoint_url, config=config
+                    )
+                    for event_name, handler in self.event_hooks:
+                        client.meta.events.register(event_name, handler)
+                    self._client = client
+        return self._client
+
+    def add_event_hook(self, event_name, handler):
+        """
+        Registers handler for a botocore event on the client once it's
+        built. The storage outlives any one app, so a hook added again by
+        the next create_app() is ignored.
+        """
+        if (event_name, handler) not in self.event_hooks:
+            self.event_hooks.append((event_name, handler))
+
+    def bucket_name(self):
+        return self.bucket or os.getenv('S3_BUCKET_NAME')
+
+    def object_url(self, key):
+        return f"https://{self.bucket_name()}.s3.amazonaws.com/{key}"
+
+    def stream_upload(self, stream, key, mime_type, acl='public-read', chunk_size=MULTIPART_CHUNK_SIZE):
+        """
+        Copies a readable stream to S3 one chunk at a time, so memory stays
+        at one chunk whatever the size of the upload and nothing is written
+        to local disk. The ACL and content type go on the create call rather
+        than a separate ObjectAcl round trip. Anything that fits in one chunk
+        is a single PutObject. Returns the object URL.
+        """
+        client = self.client
+        bucket = self.bucket_name()
+
+        chunk = read_chunk(stream, chunk_size)
+        if len(chunk) < chunk_size:
+            client.put_object(Bucket=bucket, Key=key, Body=chunk, ACL=acl, ContentType=mime_type)
+            return self.object_url(key)
+
+        upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=key, ACL=acl, ContentType=mime_type
+        )['UploadId']
+        parts = []
+        try:
+            while chunk:
+                part = client.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id,
+                    PartNumber=len(parts) + 1, Body=chunk
+                )
+                parts.append({'ETag': part['ETag'], 'PartNumber': len(parts) + 1})
+                chunk = read_chunk(stream, chunk_size)
+
+            client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+        return self.object_url(key)
+
+    def open_object(self, key):
+        """Returns a streaming body for reading an object back."""
+        return self.client.get_object(Bucket=self.bucket_name(), Key=key)['Body']
+
+    def presigned_url(self, key, expires_in=3600):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket_name(), 'Key': key}, ExpiresIn=expires_in
+        )
+
+    def delete_object(self, key):
+        self.client.delete_object(Bucket=self.bucket_name(), Key=key)
+
+    def delete_prefix(self, prefix):
+        """Deletes every object under prefix, a listing page (up to 1000 keys) per request."""
+        bucket = self.bucket_name()
+        deleted = 0
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                self.client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+                deleted += len(objects)
+        return deleted
+
+storage = Storage()
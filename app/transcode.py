@@ -0,0 +1,182 @@
+"""
+Image and video rendering for the media worker. Pillow and moviepy are
+slow to import and only the worker needs them, so the web app imports this
+module inside the job handlers rather than at startup.
+"""
+import os
+import subprocess
+import tempfile
+from io import BytesIO
+from PIL import Image, ImageOps
+import moviepy.editor as mp
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+STANDARD_VIDEO_HEIGHT = 720
+
+# feed images render at most 760 CSS px wide, so these cover small phones
+# up to 1.5x displays
+DERIVATIVE_WIDTHS = (160, 480, 1080)
+# (extension, mime type, Pillow save options); the last one is the fallback
+DERIVATIVE_FORMATS = (
+    ('webp', 'image/webp', {'format': 'WEBP', 'quality': 80, 'method': 4}),
+    ('jpg', 'image/jpeg', {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+# HLS renditions as (name, height, video bitrate, audio bitrate), lowest first.
+# Rungs taller than the source are skipped.
+HLS_LADDER = (
+    ('360p', 360, '800k', '96k'),
+    ('540p', 540, '1800k', '128k'),
+    ('720p', 720, '3000k', '128k'),
+)
+HLS_SEGMENT_SECONDS = 4
+
+POSTER_HEIGHT = 720
+PREVIEW_HEIGHT = 240
+PREVIEW_BITRATE = '300k'
+PREVIEW_SECONDS = 6
+
+
+def load_image(source, max_width):
+    """
+    Opens an image for downscaling to at most max_width. JPEGs are decoded
+    straight at a reduced scale via draft(). The result is upright and RGB,
+    with any transparency flattened onto white.
+    """
+    img = Image.open(source)
+    img.draft('RGB', (max_width, max_width))
+    img = ImageOps.exif_transpose(img)
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+
+def scale_to_width(img, width):
+    """Downscales to width, using a cheap integer reduce() before the final filter."""
+    if img.width <= width:
+        return img
+    factor = img.width // width
+    if factor >= 2:
+        img = img.reduce(factor)
+    height = max(1, round(img.height * width / img.width))
+    return img.resize((width, height), Image.LANCZOS)
+
+
+def image_derivatives(source):
+    """
+    Renders every DERIVATIVE_WIDTHS x DERIVATIVE_FORMATS variant of an image,
+    never upscaling. Each width is scaled from the previous, larger one.
+    Returns a list of (width, height, extension, mime_type, buffer).
+    """
+    img = load_image(source, max(DERIVATIVE_WIDTHS))
+    widths = sorted({min(width, img.width) for width in DERIVATIVE_WIDTHS}, reverse=True)
+
+    variants = []
+    for width in widths:
+        img = scale_to_width(img, width)
+        for extension, mime_type, options in DERIVATIVE_FORMATS:
+            buffer = BytesIO()
+            img.save(buffer, **options)
+            buffer.seek(0)
+            variants.append((img.width, img.height, extension, mime_type, buffer))
+    return variants
+
+
+def avatar(source, size):
+    """Crops an image to a size x size square JPEG. Returns the buffer."""
+    img = ImageOps.fit(load_image(source, size), (size, size), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=85, optimize=True)
+    buffer.seek(0)
+    return buffer
+
+
+def transcode_video(source):
+    """
+    Re-encodes a video (a path or URL ffmpeg can read) to H.264 no taller
+    than STANDARD_VIDEO_HEIGHT. Returns the path of a temporary output file
+    the caller removes.
+    """
+    fd, output_path = tempfile.mkstemp(suffix='.mp4')
+    os.close(fd)
+    with mp.VideoFileClip(source) as clip:
+        if clip.h > STANDARD_VIDEO_HEIGHT:
+            clip = clip.resize(height=STANDARD_VIDEO_HEIGHT)
+        clip.write_videofile(output_path, codec='libx264', audio_codec='aac', logger=None)
+    return output_path
+
+
+def ffmpeg(*args):
+    subprocess.run(
+        [get_setting('FFMPEG_BINARY'), '-hide_banner', '-loglevel', 'error', '-y', *args],
+        check=True
+    )
+
+
+def even(value):
+    return value - value % 2
+
+
+def video_renditions(source, workdir):
+    """
+    Renders a poster frame, a short muted low-bitrate preview and an HLS
+    ladder with keyframe-aligned segments into workdir, from one source
+    that ffmpeg can read. Returns the source's (width, height).
+    """
+    info = ffmpeg_parse_infos(source)
+    width, height = info['video_size']
+    duration = info['duration'] or 0
+
+    ffmpeg(
+        '-ss', str(min(1.0, duration / 2)), '-i', source,
+        '-frames:v', '1', '-vf', f"scale=-2:{even(min(POSTER_HEIGHT, height))}", '-q:v', '3',
+        os.path.join(workdir, 'poster.jpg')
+    )
+
+    ffmpeg(
+        '-i', source, '-t', str(PREVIEW_SECONDS), '-an',
+        '-vf', f"scale=-2:{even(min(PREVIEW_HEIGHT, height))}",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', PREVIEW_BITRATE,
+        '-maxrate', PREVIEW_BITRATE, '-bufsize', '600k', '-movflags', '+faststart',
+        os.path.join(workdir, 'preview.mp4')
+    )
+
+    ladder = [rung for rung in HLS_LADDER if rung[1] <= height] or [('source', even(height), *HLS_LADDER[0][2:])]
+    has_audio = info['audio_found']
+
+    split = ''.join(f"[v{i}]" for i in range(len(ladder)))
+    filters = [f"[0:v]split={len(ladder)}{split}"]
+    filters += [f"[v{i}]scale=-2:{rung_height}[out{i}]" for i, (_, rung_height, _, _) in enumerate(ladder)]
+
+    args = ['-i', source, '-filter_complex', ';'.join(filters)]
+    stream_map = []
+    for i, (name, _, video_bitrate, audio_bitrate) in enumerate(ladder):
+        args += ['-map', f"[out{i}]", f"-b:v:{i}", video_bitrate, f"-maxrate:v:{i}", video_bitrate,
+                 f"-bufsize:v:{i}", video_bitrate]
+        if has_audio:
+            args += ['-map', '0:a:0', f"-b:a:{i}", audio_bitrate]
+            stream_map.append(f"v:{i},a:{i},name:{name}")
+        else:
+            stream_map.append(f"v:{i},name:{name}")
+
+    hls_dir = os.path.join(workdir, 'hls')
+    os.makedirs(hls_dir)
+    ffmpeg(
+        *args,
+        '-c:v', 'libx264', '-preset', 'veryfast', '-sc_threshold', '0',
+        '-force_key_frames', f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+        *(['-c:a', 'aac'] if has_audio else []),
+        '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(hls_dir, '%v', 'segment_%03d.ts'),
+        '-master_pl_name', 'master.m3u8',
+        '-var_stream_map', ' '.join(stream_map),
+        os.path.join(hls_dir, '%v', 'index.m3u8')
+    )
+    return width, height
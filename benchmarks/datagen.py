@@ -0,0 +1,175 @@
+"""
+Seeds a database with synthetic users, spots, posts, likes and comments.
+
+Rows are split across the tables roughly the way a real feed grows (most of
+them likes and comments) and written with bulk inserts, so a million rows
+takes about a minute on SQLite. The same seed always produces the same
+data, and each post's like and comment counters match its rows.
+
+    python -m benchmarks.datagen --rows 100000 --database sqlite:////tmp/bench.db
+"""
+import argparse
+import datetime
+import random
+import time
+import numpy as np
+from sqlalchemy import insert
+from app import bcrypt, db, geo
+from app.models import Comment, Like, Post, Spot, User
+
+BATCH_SIZE = 10000
+PASSWORD = 'password1'
+
+# share of the rows that go to each table
+SHARES = {'users': 0.02, 'spots': 0.01, 'posts': 0.2, 'likes': 0.5, 'comments': 0.27}
+
+WORDS = ('kickflip heelflip ollie grind slide manual ledge rail stairs gap bank bowl '
+         'transition street park night session line clip first try finally landed').split()
+CITIES = [(40.71, -74.0), (34.05, -118.24), (51.51, -0.13), (35.68, 139.69), (-33.87, 151.21), (52.52, 13.4)]
+
+EPOCH = datetime.datetime(2024, 1, 1)
+SPAN_MINUTES = 365 * 24 * 60
+
+
+def plan(rows):
+    """How many rows each table gets for a total of rows, at least one user and post."""
+    counts = {table: int(rows * share) for table, share in SHARES.items()}
+    counts['users'] = max(counts['users'], 1)
+    counts['spots'] = max(counts['spots'], 1)
+    counts['posts'] = max(counts['posts'], 1)
+    # a user can like a post only once
+    counts['likes'] = min(counts['likes'], counts['users'] * counts['posts'])
+    return counts
+
+
+def insert_batches(table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.session.execute(insert(table), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(table), batch)
+
+
+def caption(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6)))
+
+
+def seed_users(count):
+    password = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+    insert_batches(User.__table__, (
+        {'username': f'skater{i}', 'email': f'skater{i}@example.com', 'password': password,
+         'profile_pic': '/static/default_pfp.jpg'}
+        for i in range(count)
+    ))
+
+
+def seed_spots(count, users, rng):
+    centres = np.array([CITIES[i % len(CITIES)] for i in range(count)])
+    latitudes = centres[:, 0] + np.array([rng.gauss(0, 0.1) for _ in range(count)])
+    longitudes = centres[:, 1] + np.array([rng.gauss(0, 0.1) for _ in range(count)])
+    geohashes = geo.encode_many(latitudes, longitudes)
+    insert_batches(Spot.__table__, (
+        {'name': f'{rng.choice(WORDS)} spot {i}', 'description': caption(rng), 'latitude': float(latitudes[i]),
+         'longitude': float(longitudes[i]), 'geohash': geohashes[i], 'user_id': rng.randint(1, users)}
+        for i in range(count)
+    ))
+
+
+def draw_engagement(counts, rng):
+    """
+    Picks who liked and commented on what, skewed toward recent posts.
+    Returns the like (user_id, post_id) pairs and comment rows.
+    """
+    posts = counts['posts']
+
+    def pick_post():
+        # newer posts (higher ids) collect more engagement
+        return posts - int(rng.betavariate(1, 3) * posts)
+
+    likes = set()
+    while len(likes) < counts['likes']:
+        likes.add((rng.randint(1, counts['users']), pick_post()))
+
+    comments = []
+    for _ in range(counts['comments']):
+        post_id = pick_post()
+        posted = EPOCH + datetime.timedelta(minutes=post_id * SPAN_MINUTES // posts + rng.randint(1, 10000))
+        comments.append({'text': caption(rng), 'user_id': rng.randint(1, counts['users']), 'post_id': post_id,
+                         'timestamp': posted})
+    return sorted(likes), comments
+
+
+def seed_posts(counts, likes, comments, rng):
+    posts = counts['posts']
+    like_counts = [0] * (posts + 1)
+    comment_counts = [0] * (posts + 1)
+    for _, post_id in likes:
+        like_counts[post_id] += 1
+    for comment in comments:
+        comment_counts[comment['post_id']] += 1
+
+    def rows():
+        for post_id in range(1, posts + 1):
+            prefix = f'https://bench.s3.amazonaws.com/images/{post_id}'
+            yield {
+                'id': post_id,
+                'content': f'{prefix}/1080.jpg',
+                'caption': caption(rng),
+                'user_id': rng.randint(1, counts['users']),
+                'spot_id': rng.randint(1, counts['spots']) if rng.random() < 0.7 else None,
+                'timestamp': EPOCH + datetime.timedelta(minutes=post_id * SPAN_MINUTES // posts),
+                'media_type': 'image',
+                'status': 'ready',
+                'like_count': like_counts[post_id],
+                'comment_count': comment_counts[post_id],
+                'version': 1,
+                'media_variants': {'image': {
+                    'width': 1080, 'height': 810, 'src': f'{prefix}/1080.jpg',
+                    'srcset': {
+                        'webp': f'{prefix}/160.webp 160w, {prefix}/480.webp 480w, {prefix}/1080.webp 1080w',
+                        'jpg': f'{prefix}/160.jpg 160w, {prefix}/480.jpg 480w, {prefix}/1080.jpg 1080w'
+                    }
+                }}
+            }
+
+    insert_batches(Post.__table__, rows())
+
+
+def generate(rows, seed=0):
+    """Fills the current app's (empty) database. Returns the row counts per table."""
+    rng = random.Random(seed)
+    counts = plan(rows)
+    seed_users(counts['users'])
+    seed_spots(counts['spots'], counts['users'], rng)
+    # engagement is drawn first so the posts go in with matching counters
+    likes, comments = draw_engagement(counts, rng)
+    seed_posts(counts, likes, comments, rng)
+    insert_batches(Like.__table__, ({'user_id': user_id, 'post_id': post_id} for user_id, post_id in likes))
+    insert_batches(Comment.__table__, comments)
+    db.session.commit()
+    return counts
+
+
+def main():
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='total rows across all tables')
+    parser.add_argument('--database', required=True, help='SQLAlchemy URL of an empty database')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        counts = generate(args.rows, args.seed)
+        print(f"seeded {sum(counts.values())} rows in {time.perf_counter() - start:.1f}s: "
+              + ', '.join(f'{count} {table}' for table, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Measures dashboard render time with and without the post card fragment cache.
+
+Seeds users and image posts, then walks the feed page by page through the
+test client, once with every card rendered from scratch and once with the
+cards already cached, and also times the card rendering on its own.
+
+    python -m benchmarks.feed_render --posts 10000 --pages 50
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+from flask_login import login_user
+from sqlalchemy import insert
+from app import create_app, db
+from app.cache import cache
+from app.fragments import render_post_cards
+from app.models import Post, Spot, User
+
+BATCH_SIZE = 5000
+
+
+def seed(posts, users, rng):
+    db.session.execute(insert(User.__table__), [
+        {'username': f'skater{i}', 'email': f'skater{i}@example.com', 'password': 'x',
+         'profile_pic': f'https://bench.s3.amazonaws.com/avatars/{i}/160.jpg'}
+        for i in range(users)
+    ])
+    db.session.execute(insert(Spot.__table__), [
+        {'name': f'spot {i}', 'description': 'synthetic', 'latitude': rng.uniform(-60, 60),
+         'longitude': rng.uniform(-170, 170), 'geohash': None}
+        for i in range(200)
+    ])
+
+    start = datetime.datetime(2024, 1, 1)
+    for offset in range(0, posts, BATCH_SIZE):
+        rows = []
+        for i in range(offset, min(offset + BATCH_SIZE, posts)):
+            prefix = f'https://bench.s3.amazonaws.com/images/{i}'
+            rows.append({
+                'content': f'{prefix}/1080.jpg',
+                'caption': f'clip number {i} at the ledge',
+                'user_id': rng.randint(1, users),
+                'spot_id': rng.randint(1, 200),
+                'timestamp': start + datetime.timedelta(minutes=i),
+                'media_type': 'image',
+                'status': 'ready',
+                'like_count': rng.randint(0, 500),
+                'comment_count': rng.randint(0, 50),
+                'version': 1,
+                'media_variants': {'image': {
+                    'width': 1080, 'height': 810, 'src': f'{prefix}/1080.jpg',
+                    'srcset': {
+                        'webp': f'{prefix}/160.webp 160w, {prefix}/480.webp 480w, {prefix}/1080.webp 1080w',
+                        'jpg': f'{prefix}/160.jpg 160w, {prefix}/480.jpg 480w, {prefix}/1080.jpg 1080w'
+                    }
+                }}
+            })
+        db.session.execute(insert(Post.__table__), rows)
+    db.session.commit()
+
+
+def walk_feed(client, pages, clear_cache):
+    """Requests the first pages of the feed in order. Returns per-page ms."""
+    timings = []
+    cursor = None
+    for _ in range(pages):
+        if clear_cache:
+            cache.clear()
+        params = {'format': 'json'}
+        if cursor:
+            params['cursor'] = cursor
+        start = time.perf_counter()
+        response = client.get('/dashboard', query_string=params)
+        timings.append((time.perf_counter() - start) * 1000)
+        cursor = response.json['next_cursor']
+        if not cursor:
+            break
+    return timings
+
+
+def time_card_rendering(app, pages, clear_cache):
+    timings = []
+    with app.test_request_context():
+        for page in range(pages):
+            posts, _ = Post.feed(cursor=None if page == 0 else cursor)
+            cursor = Post.encode_cursor(posts[-1])
+            if clear_cache:
+                cache.clear()
+            else:
+                render_post_cards(posts)
+            start = time.perf_counter()
+            render_post_cards(posts)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:>22}: p50 {statistics.median(timings):7.2f} ms   p95 {p95:7.2f} ms   n={len(timings)}")
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            'CACHE_MAX_ENTRIES': args.pages * 40 + 1000,
+            'TESTING': True
+        })
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            seed(args.posts, args.users, rng)
+            print(f"seeded {args.posts} posts in {time.perf_counter() - start:.1f}s")
+
+            viewer = User.query.get(1)
+
+            @app.before_request
+            def log_in_viewer():
+                login_user(User.cached(viewer.id))
+
+            client = app.test_client()
+            cold = summarize('page, cold cache', walk_feed(client, args.pages, clear_cache=True))
+            walk_feed(client, args.pages, clear_cache=False)
+            warm = summarize('page, warm cache', walk_feed(client, args.pages, clear_cache=False))
+
+            cards_cold = summarize('cards only, rendered', time_card_rendering(app, args.pages, clear_cache=True))
+            cards_warm = summarize('cards only, cached', time_card_rendering(app, args.pages, clear_cache=False))
+
+            print(f"page speedup {cold / warm:.1f}x, card rendering speedup {cards_cold / cards_warm:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Measures like and comment throughput through the routes under concurrent
+clients, with writes batched by the write buffer or, with --sync, written
+one transaction per request.
+
+Each thread logs in its own user and repeatedly likes and comments on a
+small set of hot posts through the test client. Rate limits are off so
+every request is written. After the run the stored like and comment
+counts are checked against the rows they count.
+
+    python -m benchmarks.ingest_contention --threads 16 --ops 100
+    python -m benchmarks.ingest_contention --threads 16 --ops 100 --sync
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from app import bcrypt, create_app, db
+from app.ingest import writes
+from app.models import Comment, Like, Post, User
+from benchmarks import datagen
+
+
+def seed(users, posts):
+    password = bcrypt.generate_password_hash(datagen.PASSWORD).decode('utf-8')
+    db.session.add_all(User(username=f'user{i}', email=f'user{i}@example.com', password=password) for i in range(users))
+    db.session.flush()
+    db.session.add_all(Post(content='https://example.com/a.jpg', user_id=1) for _ in range(posts))
+    db.session.commit()
+
+
+def client(app, user, posts, ops, barrier, timings, errors):
+    session = app.test_client()
+    session.post('/login', data={'username': f'user{user}', 'password': datagen.PASSWORD})
+    barrier.wait()
+    for op in range(ops):
+        post_id = (user + op) % posts + 1
+        start = time.perf_counter()
+        if op % 4 == 3:
+            response = session.post(f'/api/posts/{post_id}/comments', data={'text': 'nice line'})
+        else:
+            response = session.post(f'/like_post/{post_id}')
+        timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            errors.append(response.status_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=100, help='requests per thread, one in four a comment')
+    parser.add_argument('--posts', type=int, default=5, help='number of hot posts everyone writes to')
+    parser.add_argument('--sync', action='store_true', help='write each like and comment in its own transaction')
+    parser.add_argument('--buffer-ms', type=float, default=5, help='how long a batch gathers writes')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            'TESTING': True,
+            'WTF_CSRF_ENABLED': False,
+            'SLOW_REQUEST_MS': float('inf'),
+            'RATE_LIMITS': None,
+            'WRITE_BUFFER_MS': 0 if args.sync else args.buffer_ms
+        })
+        with app.app_context():
+            db.create_all()
+            seed(args.threads, args.posts)
+            db.session.remove()
+
+        timings = []
+        errors = []
+        barrier = threading.Barrier(args.threads + 1)
+        threads = [
+            threading.Thread(target=client, args=(app, i, args.posts, args.ops, barrier, timings, errors))
+            for i in range(args.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        answered = time.perf_counter() - start
+        with app.app_context():
+            writes.flush()
+            elapsed = time.perf_counter() - start
+            counted = db.session.query(db.func.sum(Post.like_count), db.func.sum(Post.comment_count)).one()
+            stored = Like.query.count(), Comment.query.count()
+
+        timings.sort()
+        total = len(timings)
+        print(f"{'sync' if args.sync else f'buffered ({args.buffer_ms:g}ms)'}, "
+              f"{args.threads} clients x {args.ops} writes on {args.posts} posts")
+        print(f"{total / elapsed:.0f} writes/s, all answered in {answered:.2f}s and written in {elapsed:.2f}s")
+        print(f"p50 {statistics.median(timings):.1f} ms   p95 {timings[int(total * 0.95)]:.1f} ms   "
+              f"p99 {timings[int(total * 0.99)]:.1f} ms   max {timings[-1]:.1f} ms")
+        print(f"{len(errors)} requests failed, {stored[0]} likes and {stored[1]} comments stored")
+        if tuple(counted) != stored:
+            raise SystemExit(f'post counters {tuple(counted)} disagree with the rows {stored}')
+
+
+if __name__ == '__main__':
+    main()
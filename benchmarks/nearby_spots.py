@@ -0,0 +1,101 @@
+"""
+Benchmarks Spot.nearby() against a full-table scan on a synthetic spot table.
+
+    python -m benchmarks.nearby_spots --spots 1000000 --queries 200
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import numpy as np
+from sqlalchemy import insert
+from app import create_app, db, geo
+from app.models import Spot
+
+BATCH_SIZE = 50000
+
+
+def seed_spots(count, rng):
+    # spots bunch up around cities, so cluster most of them around random centres
+    centres = np.column_stack([rng.uniform(-55, 65, 500), rng.uniform(-170, 170, 500)])
+    picks = rng.integers(0, len(centres), count)
+    latitudes = np.clip(centres[picks, 0] + rng.normal(0, 0.4, count), -89.9, 89.9)
+    longitudes = (centres[picks, 1] + rng.normal(0, 0.4, count) + 180.0) % 360.0 - 180.0
+
+    for start in range(0, count, BATCH_SIZE):
+        lats = latitudes[start:start + BATCH_SIZE]
+        lngs = longitudes[start:start + BATCH_SIZE]
+        geohashes = geo.encode_many(lats, lngs)
+        db.session.execute(insert(Spot.__table__), [
+            {'name': f'spot {start + i}', 'description': 'synthetic', 'latitude': float(lat),
+             'longitude': float(lng), 'geohash': geohash}
+            for i, (lat, lng, geohash) in enumerate(zip(lats, lngs, geohashes))
+        ])
+    db.session.commit()
+    return centres
+
+
+def full_scan(latitude, longitude, radius_km, limit):
+    candidates = db.session.query(Spot.id, Spot.latitude, Spot.longitude).all()
+    return geo.nearest(latitude, longitude, candidates, radius_km, limit)
+
+
+def indexed(latitude, longitude, radius_km, limit):
+    return [(spot.id, distance) for spot, distance in Spot.nearby(latitude, longitude, radius_km, limit)]
+
+
+def time_queries(search, points, radius_km, limit):
+    timings = []
+    results = []
+    for latitude, longitude in points:
+        start = time.perf_counter()
+        results.append(search(latitude, longitude, radius_km, limit))
+        timings.append((time.perf_counter() - start) * 1000)
+        db.session.rollback()
+    return timings, results
+
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:>10}: p50 {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms   n={len(timings)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--spots', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--scan-queries', type=int, default=5, help='full scans are slow, so run fewer')
+    parser.add_argument('--radius', type=float, default=5.0)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.db')}"})
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            centres = seed_spots(args.spots, rng)
+            print(f"seeded {args.spots} spots in {time.perf_counter() - start:.1f}s")
+
+            picks = rng.integers(0, len(centres), args.queries)
+            points = [
+                (float(centres[i, 0] + rng.normal(0, 0.2)), float(centres[i, 1] + rng.normal(0, 0.2)))
+                for i in picks
+            ]
+
+            indexed_timings, indexed_results = time_queries(indexed, points, args.radius, args.limit)
+            scan_timings, scan_results = time_queries(full_scan, points[:args.scan_queries], args.radius, args.limit)
+
+            for expected, actual in zip(scan_results, indexed_results):
+                assert [spot_id for spot_id, _ in expected] == [spot_id for spot_id, _ in actual]
+
+            summarize('indexed', indexed_timings)
+            summarize('full scan', scan_timings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""
+Load benchmark for the main routes, with p50/p95/p99 latency, query counts
+and peak memory per scenario, written to JSON for comparing runs.
+
+Seeds a database with benchmarks.datagen (or reuses one already seeded),
+logs in through the test client and replays a fixed, seeded mix of
+requests per scenario after a warm-up. S3 is a stubbed client with
+nothing queued, so a route that reaches for S3 fails instead of going to
+the network. Peak memory is measured with tracemalloc on a separate,
+shorter pass so tracing doesn't skew the latencies.
+
+    python -m benchmarks.routes --rows 100000 --output results.json
+    python -m benchmarks.routes --rows 100000 --compare results.json --max-regression 20
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import boto3
+from botocore.stub import Stubber
+from sqlalchemy import event
+from app import create_app, db
+from app.cache import cache
+from app.models import Post, User
+from app.storage import storage
+from benchmarks import datagen
+
+
+def scenarios(posts, rng):
+    """name -> function returning the next (method, url, data) for that scenario."""
+    recent = lambda: rng.randint(max(1, posts - 500), posts)
+    city = lambda: rng.choice(datagen.CITIES)
+    feed = {'cursor': None, 'depth': 0}
+
+    def feed_scroll():
+        # scrolls 20 pages deep, then starts again from the top
+        if feed['depth'] == 20:
+            feed.update(cursor=None, depth=0)
+        feed['depth'] += 1
+        params = 'format=json' + (f"&cursor={feed['cursor']}" if feed['cursor'] else '')
+        return 'GET', f'/dashboard?{params}', None
+
+    def viewport(zoom, span):
+        latitude, longitude = city()
+        bbox = f'{latitude - span:.4f},{longitude - span:.4f},{latitude + span:.4f},{longitude + span:.4f}'
+        return 'GET', f'/api/spots?bbox={bbox}&zoom={zoom}', None
+
+    return {
+        'dashboard': lambda: ('GET', '/dashboard', None),
+        'feed_scroll': feed_scroll,
+        'hot_feed': lambda: ('GET', '/dashboard?sort=hot', None),
+        'search_posts': lambda: ('GET', f'/search_posts?query={rng.choice(datagen.WORDS)}', None),
+        'spot_map': lambda: ('GET', '/spot_map', None),
+        'spots_viewport': lambda: viewport(16, 0.01),
+        'spots_clusters': lambda: viewport(8, 1.0),
+        'nearby_spots': lambda: ('GET', '/api/spots/nearby?lat={:.4f}&lng={:.4f}'.format(*city()), None),
+        'like_post': lambda: ('POST', f'/like_post/{recent()}', None),
+        'comments': lambda: ('GET', f'/comments/{recent()}', None),
+        'comments_api': lambda: ('GET', f'/api/posts/{recent()}/comments', None),
+        'post_comment': lambda: ('POST', f'/api/posts/{recent()}/comments', {'text': 'benchmark comment'}),
+    }, feed
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.record)
+
+    def record(self, *args):
+        self.count += 1
+
+
+def run_scenario(client, counter, next_request, feed, requests, warmup, cold):
+    def send():
+        method, url, data = next_request()
+        if cold:
+            cache.clear()
+        queries = counter.count
+        start = time.perf_counter()
+        response = client.open(url, method=method, data=data)
+        elapsed = (time.perf_counter() - start) * 1000
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {url} returned {response.status_code}')
+        if url.startswith('/dashboard?format=json'):
+            feed['cursor'] = response.json['next_cursor']
+        return elapsed, counter.count - queries
+
+    for _ in range(warmup):
+        send()
+    return [send() for _ in range(requests)]
+
+
+def peak_memory_kb(client, counter, next_request, feed, requests, cold):
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        run_scenario(client, counter, next_request, feed, requests, 0, cold)
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stub_s3():
+    client = boto3.session.Session(
+        region_name='us-east-1', aws_access_key_id='bench', aws_secret_access_key='bench'
+    ).client('s3')
+    Stubber(client).activate()
+    storage._client = client
+
+
+def compare(results, baseline, max_regression):
+    """Prints the change in p50/p95 against a previous run. Returns the scenarios that regressed."""
+    regressed = []
+    print(f"\n{'vs baseline':>16}   {'p50':>8}   {'p95':>8}   {'queries':>8}")
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if not before:
+            continue
+        p50 = (result['p50_ms'] / before['p50_ms'] - 1) * 100
+        p95 = (result['p95_ms'] / before['p95_ms'] - 1) * 100
+        queries = result['queries_mean'] - before['queries_mean']
+        print(f"{name:>16}   {p50:+7.1f}%   {p95:+7.1f}%   {queries:+8.1f}")
+        if max_regression is not None and p95 > max_regression:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='rows to seed (10k to 1M)')
+    parser.add_argument('--database', help='SQLAlchemy URL; seeded if empty, reused as is otherwise')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--memory-requests', type=int, default=20, help='requests per scenario traced for memory')
+    parser.add_argument('--scenario', action='append', help='run only these scenarios')
+    parser.add_argument('--cold', action='store_true', help='clear the app cache before every request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, help='exit 1 if any p95 grew by more than this percent')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = args.database or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': uri,
+            'TESTING': True,
+            'WTF_CSRF_ENABLED': False,
+            # the harness reports slow requests itself
+            'SLOW_REQUEST_MS': float('inf'),
+            # one user sends every request
+            'RATE_LIMITS': None
+        })
+        stub_s3()
+
+        with app.app_context():
+            db.create_all()
+            if not db.session.query(Post.query.exists()).scalar():
+                start = time.perf_counter()
+                counts = datagen.generate(args.rows, args.seed)
+                print(f"seeded {sum(counts.values())} rows in {time.perf_counter() - start:.1f}s")
+            posts = db.session.query(db.func.max(Post.id)).scalar()
+            username = db.session.query(User.username).order_by(User.id).limit(1).scalar()
+            engine = db.engine
+            db.session.remove()
+
+        # requests run outside the app context above, so each gets its own
+        # session like it would in production
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': datagen.PASSWORD})
+        counter = QueryCounter(engine)
+
+        rng = random.Random(args.seed)
+        available, feed = scenarios(posts, rng)
+        selected = args.scenario or list(available)
+        results = {
+            'meta': {
+                'revision': git_revision(),
+                'date': datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'database': engine.dialect.name,
+                'posts': posts,
+                'rows': args.rows,
+                'requests': args.requests,
+                'cold': args.cold,
+                'seed': args.seed
+            },
+            'scenarios': {}
+        }
+
+        print(f"{'scenario':>16}   {'p50':>8}   {'p95':>8}   {'p99':>8}   {'queries':>7}   {'peak':>8}")
+        for name in selected:
+            samples = run_scenario(client, counter, available[name], feed, args.requests, args.warmup, args.cold)
+            timings = [elapsed for elapsed, _ in samples]
+            queries = [count for _, count in samples]
+            peak = peak_memory_kb(client, counter, available[name], feed, args.memory_requests, args.cold)
+            result = {
+                'requests': len(samples),
+                'p50_ms': round(statistics.median(timings), 3),
+                'p95_ms': round(percentile(timings, 0.95), 3),
+                'p99_ms': round(percentile(timings, 0.99), 3),
+                'mean_ms': round(statistics.mean(timings), 3),
+                'queries_mean': round(statistics.mean(queries), 2),
+                'queries_max': max(queries),
+                'peak_memory_kb': peak
+            }
+            results['scenarios'][name] = result
+            print(f"{name:>16}   {result['p50_ms']:6.2f}ms   {result['p95_ms']:6.2f}ms   {result['p99_ms']:6.2f}ms   "
+                  f"{result['queries_mean']:7.1f}   {peak:6d}KB")
+        engine.dispose()
+
+        # kilobytes on Linux, bytes on macOS
+        results['meta']['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.max_regression)
+        if regressed:
+            print(f"p95 regressed by more than {args.max_regression}% in: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Per-upload overhead of building a fresh boto3 client for every upload versus
+the shared Storage client, against a local S3 stand-in.
+
+    python -m benchmarks.s3_client_overhead --uploads 200
+"""
+import argparse
+import hashlib
+import io
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import boto3
+from app.storage import Storage
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """Answers PutObject like S3 does, over keep-alive HTTP/1.1."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('ETag', f'"{hashlib.md5(body).hexdigest()}"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def time_uploads(upload, count, payload):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        upload(f"bench/{i}.jpg", payload)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:>13}: mean {statistics.mean(timings):7.2f} ms   p50 {statistics.median(timings):7.2f} ms   p95 {p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--uploads', type=int, default=200)
+    parser.add_argument('--size-kb', type=int, default=64)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    server, endpoint = start_server()
+    payload = os.urandom(args.size_kb * 1024)
+
+    def fresh_client_upload(key, body):
+        client = boto3.client('s3', endpoint_url=endpoint)
+        client.put_object(Bucket='bench', Key=key, Body=body, ACL='public-read', ContentType='image/jpeg')
+
+    storage = Storage(bucket='bench', endpoint_url=endpoint)
+
+    def shared_client_upload(key, body):
+        storage.stream_upload(io.BytesIO(body), key, 'image/jpeg')
+
+    # warm both paths so one-off imports and endpoint resolution aren't counted
+    fresh_client_upload('warmup', payload)
+    shared_client_upload('warmup', payload)
+
+    summarize('fresh client', time_uploads(fresh_client_upload, args.uploads, payload))
+    summarize('shared client', time_uploads(shared_client_upload, args.uploads, payload))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
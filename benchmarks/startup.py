@@ -0,0 +1,135 @@
+"""
+Measures how long a fresh process takes to import the app, build it and
+answer its first request, and fails when that goes over budget or when
+startup pulls in a library only the media worker or S3 calls need.
+
+Each run is a new interpreter under python -X importtime, started in a
+temporary directory with an empty SQLite database so nothing is cached.
+The import time is the total that -X importtime reports for everything
+loaded before the first request is answered.
+
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --import-budget-ms 800 --first-request-budget-ms 1200
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# loaded lazily by the code paths that need them, never at startup
+LAZY_MODULES = ('moviepy', 'PIL', 'numpy', 'boto3', 'botocore', 'imageio', 'tensorflow')
+
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+app = create_app()
+built = time.perf_counter()
+response = app.test_client().get('/login')
+answered = time.perf_counter()
+print(json.dumps({
+    'create_app_ms': (built - started) * 1000,
+    'first_request_ms': (answered - started) * 1000,
+    'status': response.status_code,
+    'lazy_loaded': sorted({name.split('.')[0] for name in sys.modules} & set(%r)),
+}))
+''' % (LAZY_MODULES,)
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+\d+ \| *(\S+)$')
+
+
+def parse_importtime(stderr):
+    """
+    Total import time in ms, and the packages that took longest as
+    (package, ms), counting each module's own time toward its top-level
+    package.
+    """
+    total = 0
+    packages = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        own = int(match.group(1)) / 1000
+        total += own
+        package = match.group(2).split('.')[0]
+        packages[package] = packages.get(package, 0) + own
+    return total, sorted(packages.items(), key=lambda item: item[1], reverse=True)[:10]
+
+
+def run_once():
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        env['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'startup.db')}"
+        env.setdefault('LOG_LEVEL', 'WARNING')
+        start = time.perf_counter()
+        # run from the temporary directory so the app's log file lands there
+        child = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD], cwd=tmp, env=env,
+                               capture_output=True, text=True)
+        wall = (time.perf_counter() - start) * 1000
+    if child.returncode != 0:
+        raise SystemExit(f'startup failed:\n{child.stderr[-2000:]}')
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    result['import_ms'], result['slowest_imports'] = parse_importtime(child.stderr)
+    result['wall_ms'] = wall
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--import-budget-ms', type=float, default=1000,
+                        help='fail if the median import time is over this')
+    parser.add_argument('--first-request-budget-ms', type=float, default=1500,
+                        help='fail if the median time from the first import to the first response is over this')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    median = lambda key: statistics.median(run[key] for run in runs)
+    results = {
+        'import_ms': round(median('import_ms'), 1),
+        'create_app_ms': round(median('create_app_ms'), 1),
+        'first_request_ms': round(median('first_request_ms'), 1),
+        'wall_ms': round(median('wall_ms'), 1),
+        'lazy_loaded': sorted({name for run in runs for name in run['lazy_loaded']}),
+        'slowest_imports': runs[-1]['slowest_imports'],
+    }
+
+    print(f"imports           {results['import_ms']:8.1f}ms   (budget {args.import_budget_ms:g}ms)")
+    print(f"create_app        {results['create_app_ms']:8.1f}ms")
+    print(f"first request     {results['first_request_ms']:8.1f}ms   (budget {args.first_request_budget_ms:g}ms)")
+    print(f"process wall time {results['wall_ms']:8.1f}ms")
+    print('slowest packages to import:')
+    for package, ms in results['slowest_imports']:
+        print(f'  {package:<30} {ms:8.1f}ms')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'wrote {args.output}')
+
+    failures = []
+    if any(run['status'] >= 400 for run in runs):
+        failures.append('the first request failed')
+    if results['lazy_loaded']:
+        failures.append(f"startup imported {', '.join(results['lazy_loaded'])}")
+    if results['import_ms'] > args.import_budget_ms:
+        failures.append(f"imports took {results['import_ms']:.0f}ms")
+    if results['first_request_ms'] > args.first_request_budget_ms:
+        failures.append(f"first request took {results['first_request_ms']:.0f}ms")
+    if failures:
+        print('over budget: ' + '; '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Shows that storage.stream_upload keeps memory flat however big the upload.
+
+Streams a synthetic video through stream_upload into an in-process fake S3
+client and reports peak RSS growth. --buffered instead reads the whole
+payload into memory first, the way Asset.create used to, for comparison.
+
+    python -m benchmarks.upload_memory --size-mb 500
+    python -m benchmarks.upload_memory --size-mb 500 --buffered
+"""
+import argparse
+import io
+import resource
+import sys
+from app import storage
+from app.storage import Storage
+
+# growth allowed on top of one multipart chunk before the run counts as a failure
+RSS_SLACK_MB = 32
+
+
+class FakeS3:
+    """Accepts uploads the way S3 does and keeps only their sizes."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ACL, ContentType):
+        self.objects[Key] = (len(Body), ACL, ContentType)
+
+    def create_multipart_upload(self, Bucket, Key, ACL, ContentType):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {'key': Key, 'acl': ACL, 'content_type': ContentType, 'size': 0, 'parts': 0}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        upload = self.uploads[UploadId]
+        upload['size'] += len(Body)
+        upload['parts'] += 1
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        assert len(MultipartUpload['Parts']) == upload['parts']
+        self.objects[Key] = (upload['size'], upload['acl'], upload['content_type'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+class SyntheticVideo(io.RawIOBase):
+    """A request body of the given size that is generated as it is read."""
+
+    def __init__(self, size):
+        self.remaining = size
+        self.block = bytes(range(256)) * 4096
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.remaining, len(self.block))
+        buffer[:count] = self.block[:count]
+        self.remaining -= count
+        return count
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def rss_budget_mb():
+    return storage.MULTIPART_CHUNK_SIZE / (1024 * 1024) + RSS_SLACK_MB
+
+
+def measure(size_mb, buffered=False):
+    """
+    Uploads size_mb of synthetic video and returns how much peak RSS grew,
+    in MB. Peak RSS only ever goes up, so run it in a fresh process.
+    """
+    size = size_mb * 1024 * 1024
+    client = FakeS3()
+    store = Storage(bucket='bench', client=client)
+    stream = io.BufferedReader(SyntheticVideo(size))
+    baseline = peak_rss_mb()
+
+    if buffered:
+        stream = io.BytesIO(stream.read())
+    store.stream_upload(stream, 'bench.mp4', 'video/mp4')
+
+    growth = peak_rss_mb() - baseline
+    stored, acl, content_type = client.objects['bench.mp4']
+    assert stored == size and acl == 'public-read' and content_type == 'video/mp4'
+    return growth
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=500)
+    parser.add_argument('--buffered', action='store_true')
+    args = parser.parse_args()
+
+    growth = measure(args.size_mb, args.buffered)
+    budget = rss_budget_mb()
+    print(f"uploaded {args.size_mb} MB, peak RSS grew {growth:.1f} MB (budget {budget:.0f} MB)")
+    if not args.buffered and growth > budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Measures like/comment latency under concurrent writers on SQLite.
+
+Each thread repeatedly toggles a like and adds a comment on a small set of
+hot posts through the write buffer with batching off, so every write is
+its own transaction committed with commit_with_retry, the way the routes
+write with WRITE_BUFFER_MS set to 0. --legacy runs the old SQLite setup for
+comparison: rollback journal, NullPool and no busy_timeout pragma.
+
+    python -m benchmarks.write_contention --threads 16 --ops 50
+    python -m benchmarks.write_contention --threads 16 --ops 50 --legacy
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.ingest import writes
+from app.models import Post, User
+
+
+def seed(users, posts):
+    db.session.add_all(User(username=f'user{i}', email=f'user{i}@example.com', password='x') for i in range(users))
+    db.session.flush()
+    db.session.add_all(Post(content='https://example.com/a.jpg', user_id=1) for _ in range(posts))
+    db.session.commit()
+
+
+def writer(app, user_id, posts, ops, timings, errors):
+    # what the routes pass in as current_user
+    user = SimpleNamespace(id=user_id, username=f'user{user_id - 1}')
+    with app.app_context():
+        for op in range(ops):
+            post_id = (user_id + op) % posts + 1
+            start = time.perf_counter()
+            try:
+                if op % 2:
+                    writes.toggle_like(user, post_id)
+                else:
+                    writes.add_comment(user, post_id, 'nice line')
+                writes.after_write()
+            except OperationalError:
+                errors.append(op)
+            finally:
+                # a request's session ends with it, giving its connection back
+                db.session.remove()
+            timings.append((time.perf_counter() - start) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=50, help='writes per thread')
+    parser.add_argument('--posts', type=int, default=5, help='number of hot posts everyone writes to')
+    parser.add_argument('--legacy', action='store_true', help='use the old SQLite setup')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        if args.legacy:
+            config = {'SQLALCHEMY_DATABASE_URI': uri + '?timeout=20', 'SQLALCHEMY_ENGINE_OPTIONS': {}, 'SQLITE_PRAGMAS': ()}
+        else:
+            config = {'SQLALCHEMY_DATABASE_URI': uri}
+        app = create_app(dict(config, WRITE_BUFFER_MS=0))
+
+        with app.app_context():
+            db.create_all()
+            seed(args.threads, args.posts)
+            journal_mode = db.session.execute('PRAGMA journal_mode').scalar()
+            db.session.remove()
+
+        timings = []
+        errors = []
+        threads = [
+            threading.Thread(target=writer, args=(app, i + 1, args.posts, args.ops, timings, errors))
+            for i in range(args.threads)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        with app.app_context():
+            comments, likes = db.session.query(db.func.sum(Post.comment_count), db.func.sum(Post.like_count)).one()
+
+        timings.sort()
+        print(f"{'legacy' if args.legacy else 'tuned'} (journal_mode={journal_mode}), "
+              f"{args.threads} threads x {args.ops} writes in {elapsed:.2f}s")
+        print(f"p50 {statistics.median(timings):.1f} ms   p95 {timings[int(len(timings) * 0.95)]:.1f} ms   "
+              f"p99 {timings[int(len(timings) * 0.99)]:.1f} ms   max {timings[-1]:.1f} ms")
+        print(f"{len(errors)} writes failed, {comments} comments and {likes} likes stored")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""counters, media processing, jobs, geohashes and search
+
+Adds the post counters, status, renditions and version; the unique like
+constraint; spot geohashes; the job queue; content-addressed media blobs;
+and on SQLite the full-text post index. Duplicate likes are dropped and
+the counters backfilled from the existing rows. Geohashes can't be
+computed in SQL, so run `flask reindex-spots` afterwards.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 15:50:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+# the search index as this revision creates it, copied rather than imported
+# from app.search so later edits there can't change what this migration does
+SEARCH_INDEX_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(
+        caption, spot_name, spot_description, username,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_insert AFTER INSERT ON post BEGIN
+        INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+        VALUES (
+            new.id,
+            new.caption,
+            (SELECT name FROM spot WHERE id = new.spot_id),
+            (SELECT description FROM spot WHERE id = new.spot_id),
+            (SELECT username FROM "user" WHERE id = new.user_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_update AFTER UPDATE OF caption, spot_id, user_id ON post BEGIN
+        DELETE FROM post_search WHERE rowid = old.id;
+        INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+        VALUES (
+            new.id,
+            new.caption,
+            (SELECT name FROM spot WHERE id = new.spot_id),
+            (SELECT description FROM spot WHERE id = new.spot_id),
+            (SELECT username FROM "user" WHERE id = new.user_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_delete AFTER DELETE ON post BEGIN
+        DELETE FROM post_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_spot_update AFTER UPDATE OF name, description ON spot BEGIN
+        UPDATE post_search SET spot_name = new.name, spot_description = new.description
+        WHERE rowid IN (SELECT id FROM post WHERE spot_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_user_update AFTER UPDATE OF username ON "user" BEGIN
+        UPDATE post_search SET username = new.username
+        WHERE rowid IN (SELECT id FROM post WHERE user_id = new.id);
+    END
+    """
+]
+
+REBUILD_SQL = """
+    INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+    SELECT post.id, post.caption, spot.name, spot.description, "user".username
+    FROM post
+    LEFT JOIN spot ON spot.id = post.spot_id
+    LEFT JOIN "user" ON "user".id = post.user_id
+"""
+
+
+def upgrade():
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('status', sa.String(length=20), server_default='ready', nullable=False))
+        batch_op.add_column(sa.Column('media_variants', sa.JSON(), nullable=True))
+        batch_op.add_column(sa.Column('media_digest', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        batch_op.create_index('ix_post_media_digest', ['media_digest'])
+
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('avatar_digest', sa.String(length=64), nullable=True))
+        batch_op.create_index('ix_user_avatar_digest', ['avatar_digest'])
+
+    with op.batch_alter_table('spot') as batch_op:
+        batch_op.add_column(sa.Column('geohash', sa.String(length=12), nullable=True))
+        batch_op.create_index('ix_spot_geohash', ['geohash'])
+
+    op.execute('''
+        DELETE FROM "like" WHERE id NOT IN (
+            SELECT MIN(id) FROM "like" GROUP BY user_id, post_id
+        )
+    ''')
+    with op.batch_alter_table('like') as batch_op:
+        batch_op.create_unique_constraint('uq_like_user_post', ['user_id', 'post_id'])
+
+    op.execute('''
+        UPDATE post SET
+            like_count = (SELECT COUNT(*) FROM "like" WHERE "like".post_id = post.id),
+            comment_count = (SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)
+    ''')
+
+    op.create_table(
+        'job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=50), nullable=False),
+        sa.Column('payload', sa.JSON(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('run_after', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_job_status_run_after', 'job', ['status', 'run_after'])
+
+    op.create_table(
+        'media_blob',
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('kind', sa.String(length=10), nullable=False),
+        sa.Column('mime_type', sa.String(length=50), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False),
+        sa.Column('prefix', sa.String(length=100), nullable=True),
+        sa.Column('url', sa.Text(), nullable=True),
+        sa.Column('variants', sa.JSON(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('digest', 'kind')
+    )
+
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        for statement in SEARCH_INDEX_DDL:
+            op.execute(statement)
+        op.execute(REBUILD_SQL)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        for trigger in ('post_search_insert', 'post_search_update', 'post_search_delete',
+                        'post_search_spot_update', 'post_search_user_update'):
+            op.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        op.execute('DROP TABLE IF EXISTS post_search')
+
+    op.drop_table('media_blob')
+    op.drop_index('ix_job_status_run_after', table_name='job')
+    op.drop_table('job')
+
+    with op.batch_alter_table('like') as batch_op:
+        batch_op.drop_constraint('uq_like_user_post', type_='unique')
+
+    with op.batch_alter_table('spot') as batch_op:
+        batch_op.drop_index('ix_spot_geohash')
+        batch_op.drop_column('geohash')
+
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_index('ix_user_avatar_digest')
+        batch_op.drop_column('avatar_digest')
+
+    with op.batch_alter_table('post') as batch_op:
+        batch_op.drop_index('ix_post_media_digest')
+        batch_op.drop_column('version')
+        batch_op.drop_column('media_digest')
+        batch_op.drop_column('media_variants')
+        batch_op.drop_column('status')
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('like_count')
@@ -0,0 +1,39 @@
+"""indexes for hot foreign keys and sort columns
+
+The feed pages on (timestamp, id), comments are listed per post in
+(timestamp, id) order, likes are looked up by post and by user, and
+deletes find rows by their owner.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 15:50:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_timestamp_id', 'post', ['timestamp', 'id'])
+    op.create_index('ix_post_user_id', 'post', ['user_id'])
+    op.create_index('ix_post_spot_id', 'post', ['spot_id'])
+    op.create_index('ix_like_post_user', 'like', ['post_id', 'user_id'])
+    op.create_index('ix_comment_post_timestamp_id', 'comment', ['post_id', 'timestamp', 'id'])
+    op.create_index('ix_comment_user_id', 'comment', ['user_id'])
+    op.create_index('ix_spot_user_id', 'spot', ['user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_spot_user_id', table_name='spot')
+    op.drop_index('ix_comment_user_id', table_name='comment')
+    op.drop_index('ix_comment_post_timestamp_id', table_name='comment')
+    op.drop_index('ix_like_post_user', table_name='like')
+    op.drop_index('ix_post_spot_id', table_name='post')
+    op.drop_index('ix_post_user_id', table_name='post')
+    op.drop_index('ix_post_timestamp_id', table_name='post')
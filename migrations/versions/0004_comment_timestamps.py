@@ -0,0 +1,37 @@
+"""comment timestamps are required
+
+Comments used to be saved without a timestamp. Those get their post's
+timestamp, the closest thing on record, so they sort before newer
+comments and can be paginated on (timestamp, id).
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 17:05:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('''
+        UPDATE comment SET timestamp = COALESCE(
+            (SELECT post.timestamp FROM post WHERE post.id = comment.post_id),
+            CURRENT_TIMESTAMP
+        )
+        WHERE timestamp IS NULL
+    ''')
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.alter_column('timestamp', existing_type=sa.DateTime(), nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.alter_column('timestamp', existing_type=sa.DateTime(), nullable=True)
@@ -0,0 +1,125 @@
+"""cascading foreign keys
+
+Deleting a user or post now removes the rows that depend on it in the
+database, and spots outlive the user who posted them. SQLite can't alter
+constraints, so its tables are rebuilt; the search index triggers get in
+the way of that and are dropped and recreated around it.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 18:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table, ondelete)
+FOREIGN_KEYS = [
+    ('spot', 'user_id', 'user', 'SET NULL'),
+    ('post', 'user_id', 'user', 'CASCADE'),
+    ('post', 'spot_id', 'spot', 'SET NULL'),
+    ('like', 'user_id', 'user', 'CASCADE'),
+    ('like', 'post_id', 'post', 'CASCADE'),
+    ('comment', 'user_id', 'user', 'CASCADE'),
+    ('comment', 'post_id', 'post', 'CASCADE'),
+]
+
+# SQLite's reflected foreign keys are unnamed; this names them in batch mode
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+
+# the search index triggers as they were when this revision was written,
+# copied rather than imported from app.search
+SEARCH_TRIGGER_DDL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_insert AFTER INSERT ON post BEGIN
+        INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+        VALUES (
+            new.id,
+            new.caption,
+            (SELECT name FROM spot WHERE id = new.spot_id),
+            (SELECT description FROM spot WHERE id = new.spot_id),
+            (SELECT username FROM "user" WHERE id = new.user_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_update AFTER UPDATE OF caption, spot_id, user_id ON post BEGIN
+        DELETE FROM post_search WHERE rowid = old.id;
+        INSERT INTO post_search (rowid, caption, spot_name, spot_description, username)
+        VALUES (
+            new.id,
+            new.caption,
+            (SELECT name FROM spot WHERE id = new.spot_id),
+            (SELECT description FROM spot WHERE id = new.spot_id),
+            (SELECT username FROM "user" WHERE id = new.user_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_delete AFTER DELETE ON post BEGIN
+        DELETE FROM post_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_spot_update AFTER UPDATE OF name, description ON spot BEGIN
+        UPDATE post_search SET spot_name = new.name, spot_description = new.description
+        WHERE rowid IN (SELECT id FROM post WHERE spot_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS post_search_user_update AFTER UPDATE OF username ON "user" BEGIN
+        UPDATE post_search SET username = new.username
+        WHERE rowid IN (SELECT id FROM post WHERE user_id = new.id);
+    END
+    """
+]
+
+
+def constraint_name(table, column, referent):
+    for foreign_key in sa.inspect(op.get_bind()).get_foreign_keys(table):
+        if foreign_key['constrained_columns'] == [column] and foreign_key['name']:
+            return foreign_key['name']
+    return f'fk_{table}_{column}_{referent}'
+
+
+def replace_foreign_keys(ondelete_for):
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    if sqlite:
+        # the triggers name these tables, which stops SQLite renaming the copies
+        triggers = op.get_bind().exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'post_search_%'"
+        ).scalars().all()
+        for trigger in triggers:
+            op.execute(f'DROP TRIGGER {trigger}')
+
+    tables = {}
+    for table, column, referent, ondelete in FOREIGN_KEYS:
+        tables.setdefault(table, []).append((column, referent, ondelete_for(ondelete)))
+
+    for table, foreign_keys in tables.items():
+        names = [constraint_name(table, column, referent) for column, referent, _ in foreign_keys]
+        with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+            for name, (column, referent, ondelete) in zip(names, foreign_keys):
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(f'fk_{table}_{column}_{referent}', referent, [column], ['id'],
+                                            ondelete=ondelete)
+
+    if sqlite:
+        for statement in SEARCH_TRIGGER_DDL:
+            op.execute(statement)
+
+
+def upgrade():
+    replace_foreign_keys(lambda ondelete: ondelete)
+
+
+def downgrade():
+    replace_foreign_keys(lambda ondelete: None)
@@ -0,0 +1,72 @@
+"""hot feed scores
+
+Posts get a stored, decaying hot_score and an index to page the hot feed
+on (hot_score, id). Existing posts only have like and comment counts, so
+their scores are estimated as if all of it came in when they were posted;
+posts old enough to have decayed to nothing keep 0.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 20:10:00
+
+"""
+from datetime import datetime, timedelta
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+# posts older than this would decay below the floor however popular they were
+BACKFILL_DAYS = 30
+BATCH_SIZE = 5000
+
+# the scoring in app.ranking when this revision was written, copied so
+# later tuning there doesn't change what this migration backfills
+HALF_LIFE = timedelta(hours=12)
+POST_WEIGHT = 3.0
+LIKE_WEIGHT = 1.0
+COMMENT_WEIGHT = 2.0
+FLOOR = 0.05
+
+
+def estimate(timestamp, likes, comments, now):
+    if timestamp is None:
+        return 0.0
+    weight = POST_WEIGHT + LIKE_WEIGHT * likes + COMMENT_WEIGHT * comments
+    score = weight * 0.5 ** (max(now - timestamp, timedelta(0)) / HALF_LIFE)
+    return score if score >= FLOOR else 0.0
+
+
+def upgrade():
+    op.add_column('post', sa.Column('hot_score', sa.Float(), nullable=False, server_default='0'))
+    op.create_index('ix_post_hot_score_id', 'post', ['hot_score', 'id'])
+
+    post = sa.table('post', sa.column('id'), sa.column('timestamp', sa.DateTime()), sa.column('like_count'),
+                    sa.column('comment_count'), sa.column('hot_score'))
+    bind = op.get_bind()
+    now = datetime.utcnow()
+    rows = bind.execute(
+        sa.select(post.c.id, post.c.timestamp, post.c.like_count, post.c.comment_count)
+        .where(post.c.timestamp >= now - timedelta(days=BACKFILL_DAYS))
+    ).all()
+    scores = [
+        {'post_id': row.id, 'score': estimate(row.timestamp, row.like_count, row.comment_count, now)}
+        for row in rows
+    ]
+    update = post.update().where(post.c.id == sa.bindparam('post_id')).values(hot_score=sa.bindparam('score'))
+    for start in range(0, len(scores), BATCH_SIZE):
+        batch = [score for score in scores[start:start + BATCH_SIZE] if score['score']]
+        if batch:
+            bind.execute(update, batch)
+
+
+def downgrade():
+    op.drop_index('ix_post_hot_score_id', table_name='post')
+    # SQLite drops a column in place since 3.35; a batch copy of the table
+    # would trip over the search index triggers
+    op.drop_column('post', 'hot_score')
@@ -0,0 +1,20 @@
+"""
+Serves the app on gevent, where each open live-update stream is a cheap
+greenlet rather than a thread. gevent is optional and not in
+requirements.txt:
+
+    pip install gevent
+    python serve.py
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+from gevent.pywsgi import WSGIServer
+from run import app
+
+if __name__ == '__main__':
+    port = int(os.getenv('PORT', 5000))
+    app.logger.info('serving on port %d', port)
+    WSGIServer(('0.0.0.0', port), app).serve_forever()
@@ -0,0 +1,27 @@
+import sqlite3
+from app import query_plans
+
+
+def explain(statement):
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE post (id INTEGER PRIMARY KEY, caption TEXT, user_id INTEGER)')
+    connection.execute('CREATE INDEX ix_post_user_id ON post (user_id)')
+    return [row[-1] for row in connection.execute(f'EXPLAIN QUERY PLAN {statement}')]
+
+
+def test_hot_requests_use_indexes_and_fit_their_budgets():
+    failures = query_plans.check_query_plans()
+    assert failures == [], '\n'.join(f'{request}: {"; ".join(problems)}\n    {statement}'
+                                     for request, statement, problems in failures)
+
+
+def test_full_table_scan_is_a_problem():
+    assert query_plans.plan_problems(explain("SELECT id FROM post WHERE caption = 'kickflip'"))
+
+
+def test_unindexed_sort_is_a_problem():
+    assert query_plans.plan_problems(explain('SELECT id FROM post WHERE user_id = 1 ORDER BY caption'))
+
+
+def test_index_lookup_is_not_a_problem():
+    assert query_plans.plan_problems(explain('SELECT id FROM post WHERE user_id = 1 ORDER BY id')) == []
@@ -0,0 +1,28 @@
+import json
+import os
+import subprocess
+import sys
+from benchmarks import upload_memory
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, sys
+from benchmarks.upload_memory import measure
+print(json.dumps(measure(int(sys.argv[1]), sys.argv[2] == 'buffered')))
+'''
+
+
+def rss_growth_mb(size_mb, buffered=False):
+    # peak RSS never goes down, so each measurement gets a fresh interpreter
+    child = subprocess.run([sys.executable, '-c', CHILD, str(size_mb), 'buffered' if buffered else 'streamed'],
+                           cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def test_streaming_a_500mb_video_keeps_rss_flat():
+    assert rss_growth_mb(500) < upload_memory.rss_budget_mb()
+
+
+def test_buffering_the_upload_would_be_caught():
+    assert rss_growth_mb(100, buffered=True) > upload_memory.rss_budget_mb()